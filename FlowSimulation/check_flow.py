@@ -0,0 +1,65 @@
+import os
+import stat
+import sys
+import tempfile
+
+import numpy as np
+
+import flow
+
+# Check of flow.py with the MODFLOW stub (modflow_stub.py), no MODFLOW needed:
+#
+#   python check_flow.py
+#
+# A small template is built in a temporary directory and three realizations
+# with uniform K-fields run on two workers. Every link file must hold the LPF
+# package of its own realization, the scratch workspaces must be removed and
+# the template must stay in its workspace. A failing run must be reported and
+# leave no link file behind.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def lpf_array(path, name):
+    # values of an INTERNAL array of an LPF file, e.g. hk
+    with open(path) as f:
+        lines = f.readlines()
+    start = next(k for k, line in enumerate(lines) if f'#{name} ' in line) + 1
+    end = next((k for k in range(start, len(lines)) if '#' in lines[k]), len(lines))
+    return np.array(' '.join(lines[start:end]).split(), dtype=float)
+
+
+def check():
+    stub = os.path.join(HERE, 'modflow_stub.py')
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            template = flow.FlowTemplate(1, 15, 17, 1., 1., 1., exe=stub)
+            template_files = sorted(os.listdir(template.template_ws))
+            # K = real + 1 in every cell of realization real
+            kfields = np.log(np.arange(1, 4))[:, None, None]*np.ones((3, 15, 17))
+
+            results = flow.flow_simulation(template, range(3), kfields, exe=stub, n_workers=2)
+            assert results == {0: True, 1: True, 2: True}, results
+            for real in range(3):
+                assert np.allclose(lpf_array(flow.FTL_FILE.format(real), 'hk'), real + 1), real
+            assert not [name for name in os.listdir('tmp') if name.startswith('flow-')], os.listdir('tmp')
+            assert os.path.abspath(template.mf.model_ws) == os.path.abspath(template.template_ws)
+            assert sorted(os.listdir(template.template_ws)) == template_files
+
+            os.environ['MODFLOW_STUB_FAIL'] = '1'
+            try:
+                results = flow.flow_simulation(template, [1], kfields, exe=stub, keep_failed=False)
+            finally:
+                del os.environ['MODFLOW_STUB_FAIL']
+            assert results == {1: False} and not os.path.exists(flow.FTL_FILE.format(1)), results
+        finally:
+            os.chdir(cwd)
+    print('flow.py check passed')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, HERE)
+    check()
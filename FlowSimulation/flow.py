@@ -0,0 +1,135 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import flopy
+
+# MODFLOW flow simulations of the K-field ensemble.
+#
+# The model (DIS, BAS, LPF, OC, PCG and LMT packages) is built with FloPy and
+# written once to a template workspace. For every realization the template
+# files are copied to a workspace of its own, where only the LPF package is
+# written again with the hydraulic conductivity of the realization, and
+# MODFLOW runs there; several runs go on at the same time in a bounded pool of
+# threads waiting on the MODFLOW processes. The flow-transport link file of a
+# successful run is moved to tmp/model-{real}.ftl in one step (os.replace), so
+# the transport never sees a partially written file.
+#
+# exe can be any executable taking the name file as argument, e.g. the stub
+# modflow_stub.py writing a model.ftl file and printing 'Normal termination',
+# to test the workflow without MODFLOW (python check_flow.py).
+
+FTL_FILE = 'tmp/model-{}.ftl'
+LMT_FILE = 'model.ftl'
+
+
+class FlowTemplate:
+    def __init__(self, nlay, nrow, ncol, del_R, del_C, del_L, delta_h=1, exe='mf2005dbl',
+                 model_name='example_Frontiers', template_ws='tmp/flow_template'):
+        self.model_name = model_name
+        self.template_ws = template_ws
+        self.mf = flopy.modflow.Modflow(model_name, model_ws=template_ws, exe_name=exe)
+
+        # Geometric variables for the DIS package
+        ztop = 0.
+        zbot = np.broadcast_to(ztop - del_L*np.arange(1, nlay + 1)[:, None, None], (nlay, nrow, ncol))
+        flopy.modflow.ModflowDis(self.mf, nlay, nrow, ncol, delr=del_R, delc=del_C,
+                                 top=ztop, botm=np.array(zbot), perlen=1)
+
+        # Variables for the BAS package: fixed heads on the left and right
+        # boundaries and a linear starting head along x
+        ibound = np.ones((nlay, nrow, ncol), dtype=np.int32)
+        ibound[:, :, 0] = -1
+        ibound[:, :, -1] = -1
+        strt = np.broadcast_to(np.linspace(delta_h, 0, num=ncol, dtype=np.float32), (nlay, nrow, ncol))
+        flopy.modflow.ModflowBas(self.mf, ibound=ibound, strt=np.array(strt))
+
+        # hk is replaced for every realization
+        self.lpf = flopy.modflow.ModflowLpf(self.mf, hk=1., layvka=1, vka=10)
+        flopy.modflow.ModflowOc(self.mf)
+        flopy.modflow.ModflowPcg(self.mf, mxiter=500, iter1=300)
+        flopy.modflow.ModflowLmt(self.mf, output_file_header='extended', output_file_format='formatted',
+                                 output_file_name=LMT_FILE)
+        self.mf.write_input()
+        self.lpf_file = self.lpf.file_name[0]
+
+    @property
+    def namefile(self):
+        return f'{self.model_name}.nam'
+
+    def write(self, hk, workspace):
+        # the template files plus the LPF package of this realization, written
+        # to the workspace directly: the model itself stays in template_ws
+        for filename in os.listdir(self.template_ws):
+            if filename != self.lpf_file:
+                shutil.copy(os.path.join(self.template_ws, filename), workspace)
+        self.lpf.hk = hk
+        self.lpf.write_file(check=False, f=open(os.path.join(workspace, self.lpf_file), 'w'))
+
+
+def run_modflow(exe, workspace, namefile):
+    process = subprocess.run([exe, namefile], cwd=workspace, capture_output=True, text=True)
+    normal = 'normal termination' in process.stdout.lower()
+    return process.returncode == 0 and normal and os.path.exists(os.path.join(workspace, LMT_FILE))
+
+
+def _executable(exe):
+    # a local file (e.g. a stub) or a program on the PATH
+    return os.path.abspath(exe) if os.path.exists(exe) else shutil.which(exe) or exe
+
+
+def flow_simulation(template, realizations, kfields='Kfileds_Hydrogen.npy', exe='mf2005dbl', n_workers=4,
+                    ftl_file=FTL_FILE, scratch='tmp', keep_failed=True, should_stop=None):
+    # runs MODFLOW for the given realizations, returns {real: success}; when
+    # should_stop(real) returns True after a finished realization no new run is started
+    exe = _executable(exe)
+    if isinstance(kfields, str):
+        kfields = np.load(kfields, mmap_mode='r')
+    os.makedirs(scratch, exist_ok=True)
+    os.makedirs(os.path.dirname(ftl_file) or '.', exist_ok=True)
+
+    pending = iter(realizations)
+    running = {}
+    results = {}
+    stop = False
+    with ThreadPoolExecutor(n_workers) as pool:
+        while True:
+            # keep at most n_workers runs in flight, the inputs of the next
+            # realization are written while the others run
+            while not stop and len(running) < n_workers:
+                real = next(pending, None)
+                if real is None:
+                    break
+                workspace = tempfile.mkdtemp(prefix=f'flow-{real}-', dir=scratch)
+                template.write(np.exp(np.asarray(kfields[real])), workspace)
+                running[pool.submit(run_modflow, exe, workspace, template.namefile)] = (real, workspace)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                real, workspace = running.pop(future)
+                success = future.result()
+                if success:
+                    os.replace(os.path.join(workspace, LMT_FILE), ftl_file.format(real))
+                    shutil.rmtree(workspace, ignore_errors=True)
+                    print(f'flow: realization no. {real} done')
+                else:
+                    # never leave the link file of an earlier run for the transport
+                    if os.path.exists(ftl_file.format(real)):
+                        os.remove(ftl_file.format(real))
+                    print(f'FLOW SIMULATION ERROR, realization no. {real} failed' +
+                          (f' (workspace kept in {workspace})' if keep_failed else ''))
+                    if not keep_failed:
+                        shutil.rmtree(workspace, ignore_errors=True)
+                results[real] = success
+                if should_stop is not None and should_stop(real):
+                    stop = True
+
+    failed = sorted(real for real, success in results.items() if not success)
+    print(f'{len(results) - len(failed)} flow simulations done, {len(failed)} failed' +
+          (f': {failed}' if failed else ''))
+    return dict(sorted(results.items()))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import os
+import sys
+
+# Stand-in for MODFLOW, to test flow.py without it (see check_flow.py):
+#
+#   flow.flow_simulation(template, realizations, exe='modflow_stub.py')
+#
+# It reads the name file given as argument, checks that the input files listed
+# there were written, copies the LPF package of the realization to the link
+# file model.ftl in place of the fluxes and prints 'Normal termination' as
+# MODFLOW does. With MODFLOW_STUB_FAIL set it exits with an error instead.
+
+
+def main(namefile):
+    if os.environ.get('MODFLOW_STUB_FAIL'):
+        print('stub: failure requested')
+        return 1
+    lpf = None
+    with open(namefile) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#') or fields[0].upper().startswith(('LIST', 'DATA', 'LMT')):
+                continue
+            if not os.path.exists(fields[2]):
+                print(f'stub: missing input file {fields[2]}')
+                return 1
+            if fields[0].upper() == 'LPF':
+                lpf = fields[2]
+    with open(lpf) as src, open('model.ftl', 'w') as dst:
+        dst.write(src.read())
+    print(' Normal termination of simulation')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
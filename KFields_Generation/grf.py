@@ -0,0 +1,111 @@
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Native Gaussian random field generator for log-K fields, an alternative to
+# the HYDRO_GEN executable that reads the same hydrogen_input.txt.
+#
+# Fields are generated by circulant embedding: the covariance of the grid is
+# embedded in a periodic domain at least twice as large, whose covariance
+# matrix is diagonalised by the 2-D FFT. One complex FFT of white noise scaled
+# by the square root of the eigenvalues gives two independent fields (real and
+# imaginary part) with exactly the prescribed covariance on the grid.
+
+
+def read_parameters(filename='hydrogen_input.txt'):
+    inputtxt = open(filename, "r")
+    list_of_lines = inputtxt.readlines()
+    inputtxt.close()
+    dx, dy = (float(v) for v in list_of_lines[1].split()[:2])
+    Lx, Ly = (float(v) for v in list_of_lines[3].split()[:2])
+    sclx, scly = (float(v) for v in list_of_lines[8].split()[:2])
+    return {'seed': int(list_of_lines[0].split()[0]),
+            'dx': dx, 'dy': dy,
+            'nx': int(round(Lx/dx)) + 1, 'ny': int(round(Ly/dy)) + 1,
+            'itype': int(list_of_lines[5].split()[0]),
+            'sigma': float(list_of_lines[6].split()[0]),
+            'mu': float(list_of_lines[7].split()[0]),
+            'sclx': sclx, 'scly': scly}
+
+
+def covariance(hx, hy, sigma, sclx, scly, itype):
+    # covariance functions of HYDRO_GEN, sigma being the variance of ln K
+    r = np.sqrt((hx/sclx)**2 + (hy/scly)**2)
+    if itype == 1:
+        return sigma*np.exp(-r)
+    if itype == 2:
+        return sigma*np.exp(-r**2)
+    raise ValueError(f'covariance type {itype} is not supported, use 1 (exponential) or 2 (Gaussian)')
+
+
+def _fast_length(n):
+    # smallest 2^a 3^b 5^c >= n, sizes for which the FFT is fast
+    best = 2*n
+    p2 = 1
+    while p2 < best:
+        p3 = p2
+        while p3 < best:
+            p5 = p3
+            while p5 < n:
+                p5 *= 5
+            best = min(best, p5)
+            p3 *= 3
+        p2 *= 2
+    return best
+
+
+def embedding(parameters, max_refinements=4):
+    # square root of the circulant eigenvalues, normalised for np.fft.fft2
+    nx, ny = parameters['nx'], parameters['ny']
+    mx, my = _fast_length(2*(nx - 1)), _fast_length(2*(ny - 1))
+    for refinement in range(max_refinements + 1):
+        hx = np.minimum(np.arange(mx), mx - np.arange(mx))*parameters['dx']
+        hy = np.minimum(np.arange(my), my - np.arange(my))*parameters['dy']
+        c = covariance(hx[None, :], hy[:, None], parameters['sigma'],
+                       parameters['sclx'], parameters['scly'], parameters['itype'])
+        eigenvalues = np.fft.fft2(c).real
+        if eigenvalues.min() >= -1e-8*eigenvalues.max():
+            break
+        if refinement == max_refinements:
+            print(f'circulant embedding not positive definite, '
+                  f'clipping eigenvalues down to {eigenvalues.min():.3e}')
+            break
+        mx, my = _fast_length(2*mx), _fast_length(2*my)
+    return np.sqrt(np.clip(eigenvalues, 0, None)/(mx*my))
+
+
+def gaussian_fields(realization, parameters, seed=None, batch_size=32, out=None):
+    # (realization, ny, nx) ln K fields; field pair k is drawn from its own
+    # generator seeded with (seed, k), so the fields do not depend on batch_size
+    seed = parameters['seed'] if seed is None else seed
+    nx, ny = parameters['nx'], parameters['ny']
+    scale = embedding(parameters)
+    fields = np.zeros((realization, ny, nx)) if out is None else out
+
+    n_pairs = (realization + 1)//2
+    for start in range(0, n_pairs, batch_size):
+        pairs = range(start, min(start + batch_size, n_pairs))
+        noise = np.empty((len(pairs),) + scale.shape, dtype=complex)
+        for k, pair in enumerate(pairs):
+            rng = np.random.default_rng([seed, pair])
+            noise[k].real = rng.standard_normal(scale.shape)
+            noise[k].imag = rng.standard_normal(scale.shape)
+        z = np.fft.fft2(scale*noise)[:, :ny, :nx]
+        batch = np.stack((z.real, z.imag), axis=1).reshape((-1, ny, nx))
+        first = 2*pairs[0]
+        last = min(first + len(batch), realization)
+        fields[first:last] = parameters['mu'] + batch[:last - first]
+    return fields
+
+
+def field_generation(realization, seed=None, output=None, batch_size=32, input_file='hydrogen_input.txt'):
+    parameters = read_parameters(input_file)
+    out = None
+    if output is not None:
+        out = open_memmap(output, mode='w+', dtype=np.float64,
+                          shape=(realization, parameters['ny'], parameters['nx']))
+    fields = gaussian_fields(realization, parameters, seed, batch_size, out)
+    print(f'{realization} fields generated (covariance type {parameters["itype"]}, '
+          f'seed {parameters["seed"] if seed is None else seed})')
+    if output is not None:
+        fields.flush()
+    return fields
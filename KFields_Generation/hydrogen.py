@@ -1,58 +1,148 @@
 import numpy as np
-import csv
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import multiprocessing as mp
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from numpy.lib.format import open_memmap
 
-def field_generation(realization, operating_system):
-    
-    if operating_system == 'mac':
-        os.system("chmod u+x hydrogen_mac")
-    iteration = 0
-    
-    inputtxt = open('hydrogen_input.txt', "r")
+import grf
+
+
+def read_input(filename='hydrogen_input.txt'):
+    inputtxt = open(filename, "r")
     list_of_lines = inputtxt.readlines()
+    inputtxt.close()
     randomseed = int(list_of_lines[0].split(" ")[0])
     nx = int(float(list_of_lines[3].split(" ")[0])) + 1
     ny = int(float(list_of_lines[3].split(" ")[1])) + 1
     mu = float(list_of_lines[7].split(" ")[0])
     sigma = float(list_of_lines[6].split(" ")[0])
-    fields = np.zeros((realization,ny,nx))
-    
-    while iteration < realization:
-        print(f'generating a field ...')
-        modified = f'{randomseed}'
-        modified += (18 - len(modified))*' ' + '! nseed (if set to 0 the seed is generated as random, otherwise the integer provided is used as seed)\n'
-        list_of_lines[0] = modified
-        a_file = open("hydrogen_input.txt", "w")
-        a_file.writelines(list_of_lines)
+    return list_of_lines, randomseed, nx, ny, mu, sigma
+
+
+def seed_line(randomseed):
+    modified = f'{randomseed}'
+    modified += (18 - len(modified))*' ' + '! nseed (if set to 0 the seed is generated as random, otherwise the integer provided is used as seed)\n'
+    return modified
+
+
+def read_result(filename):
+    # all the values following the 'replicate' line of the HYDRO_GEN output
+    with open(filename, 'rb') as f:
+        data = f.read()
+    replicate = re.search(rb'^replicate[^\n]*\n', data, re.MULTILINE)
+    if replicate is None:
+        raise ValueError(f'no replicate found in {filename}')
+    return np.fromstring(data[replicate.end():], sep=' ')
+
+
+def accepted(hcfield, mu, sigma):
+    return ( ((mu*0.9) < hcfield.mean() and hcfield.mean() < (mu*1.1)) and
+             ((sigma*0.9) < hcfield.var() and hcfield.var() < (sigma*1.1)) )
+
+
+def run_hydrogen(randomseed, list_of_lines, executable, scratch_root=None):
+    # run HYDRO_GEN with the given seed in its own scratch directory (inside
+    # scratch_root), so that several instances never share the input and
+    # output files
+    scratch = tempfile.mkdtemp(prefix=f'seed-{randomseed}-', dir=scratch_root)
+    try:
+        lines = list(list_of_lines)
+        lines[0] = seed_line(randomseed)
+        a_file = open(os.path.join(scratch, 'hydrogen_input.txt'), "w")
+        a_file.writelines(lines)
         a_file.close()
-        
-        if operating_system == 'mac':
-            os.system("./hydrogen_mac")
-        if operating_system == 'linux':
-            os.system("./hydrogen_linux")
-
-        aquifer = []
-        record = False
-
-        with open('single_result.txt', newline='') as f:
-            reader = csv.reader(f, skipinitialspace=True, delimiter=' ', quoting=csv.QUOTE_NONE)
-            for row in reader:
-                if record:
-                    aquifer.append(row)
-                if row[0] == 'replicate':
-                    record = True        
-
-        hcfield = []
-        for i in aquifer:
-            for j in i:
-                hcfield.append(j)
-        hcfield = np.asarray(hcfield, dtype='float')
-
-        if ( ((mu*0.9) < hcfield.mean() and hcfield.mean() < (mu*1.1)) and
-            ((sigma*0.9) < hcfield.var() and hcfield.var() < (sigma*1.1)) ):
-            fields[iteration] = hcfield.reshape((ny,nx))
-            print(f'Realization No. {iteration} done')
-            iteration += 1
-        randomseed += 1
-    
-    return fields
+        # kriging coefficients are read back when imark is 1
+        coefficients = lines[11].split()[0]
+        if os.path.exists(coefficients):
+            shutil.copy(coefficients, scratch)
+
+        subprocess.run([executable], cwd=scratch, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        result = os.path.join(scratch, lines[13].split()[0])
+        if not os.path.exists(result):
+            raise RuntimeError(f'HYDRO_GEN did not write {lines[13].split()[0]} for seed {randomseed}')
+        return read_result(result)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def field_generation(realization, operating_system, n_workers=1, output=None, profiler=None, should_stop=None):
+    # profiler: optional instrumentation.Profiler (any object with its stage,
+    # task and record_task methods) timing the generation and every HYDRO_GEN run.
+    # should_stop(real) is called after every accepted HYDRO_GEN field, when it
+    # returns True no new seed is started and the fields so far are returned
+    # (e.g. ConvergenceMonitor.should_stop when the ensemble is run in batches)
+    with profiler.stage('field_generation', generator=operating_system) if profiler is not None else nullcontext():
+        # native FFT generator from the same input file, no executable and no rejection
+        if operating_system == 'numpy':
+            return grf.field_generation(realization, output=output)
+        return hydrogen_fields(realization, operating_system, n_workers, output, profiler, should_stop)
+
+
+def hydrogen_fields(realization, operating_system, n_workers=1, output=None, profiler=None, should_stop=None):
+    executable = os.path.abspath(f'hydrogen_{operating_system}')
+    if operating_system == 'mac':
+        os.chmod(executable, os.stat(executable).st_mode | 0o100)
+    iteration = 0
+
+    list_of_lines, randomseed, nx, ny, mu, sigma = read_input()
+    # stream the accepted fields into a .npy file on disk when output is given
+    if output is None:
+        fields = np.zeros((realization,ny,nx))
+    else:
+        fields = open_memmap(output, mode='w+', dtype=np.float64, shape=(realization,ny,nx))
+
+    # the scratch directories of all the runs, removed at the end even when
+    # the workers still running are terminated
+    scratch_root = tempfile.mkdtemp(prefix='hydrogen-')
+    generate = partial(run_hydrogen, list_of_lines=list_of_lines, executable=executable, scratch_root=scratch_root)
+    if profiler is not None:
+        generate = profiler.task(generate)
+    pool = mp.Pool(n_workers) if n_workers > 1 else None
+    first_seed = randomseed
+    attempts = 0
+    # at most two seeds per worker are submitted ahead; they are accepted in
+    # seed order, so the result does not depend on n_workers
+    pending = deque()
+    next_seed = randomseed
+
+    try:
+        while iteration < realization:
+            while pool is not None and len(pending) < 2*n_workers:
+                pending.append((next_seed, pool.apply_async(generate, (next_seed,))))
+                next_seed += 1
+            if pool is not None:
+                seed, job = pending.popleft()
+                hcfield = job.get()
+            else:
+                seed, hcfield = next_seed, generate(next_seed)
+                next_seed += 1
+            attempts += 1
+            randomseed = seed + 1
+            if profiler is not None:
+                hcfield, metrics = hcfield
+                profiler.record_task('hydrogen', seed, dict(metrics, accepted=bool(accepted(hcfield, mu, sigma))))
+            if accepted(hcfield, mu, sigma):
+                fields[iteration] = hcfield.reshape((ny,nx))
+                print(f'Realization No. {iteration} done')
+                iteration += 1
+                if iteration < realization and should_stop is not None and should_stop(iteration - 1):
+                    print(f'stopped after {iteration} realizations')
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    if attempts:
+        print(f'{iteration} fields accepted out of {attempts} generated '
+              f'(acceptance rate {iteration/attempts:.1%}, seeds {first_seed} to {randomseed-1})')
+    if output is not None:
+        fields.flush()
+    return fields[:iteration]
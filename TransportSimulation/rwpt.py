@@ -0,0 +1,190 @@
+import os
+from functools import partial
+
+import numpy as np
+import yaml
+
+from binning import bin_particles
+from cellindex import invalidate as invalidate_cells
+from cfield_store import CFIELD_DIR, save_cfield
+from ftl_reader import read_ftl
+from parallel import run_realizations
+
+# Random walk particle tracking in NumPy, a CPU fallback for PAR2.
+#
+# The model is read from the same config.yaml as PAR2: grid, porosity,
+# molecular diffusion, longitudinal/transverse dispersivity, velocity file,
+# number of particles and start box, dt, steps and snapshot steps. The flow
+# field comes from the MODFLOW link file (QXX, QYY records of tmp/model-{}.ftl),
+# turned into face velocities q/(area*porosity); the advective velocity of a
+# particle is interpolated linearly between the faces of its cell. Every step
+#
+#   x += (v + div D) dt + sqrt(2 (alpha_L |v| + Dm) dt) xi_L e_L + sqrt(2 (alpha_T |v| + Dm) dt) xi_T e_T
+#
+# with e_L along the velocity, e_T across it and xi_L, xi_T standard normal.
+# div D is evaluated at the cell centres and taken constant in each cell. The
+# walls y = 0 and y = Ly (no flow) reflect the particles, a particle leaving
+# through x = 0 or x = Lx (fixed heads) stops there. The model is 2D: z does
+# not move.
+#
+# All particles of a realization are moved together as arrays, realizations run
+# in parallel with n_workers processes. At the snapshot steps the particles are
+# binned in memory (binning.bin_particles, same cells as cfield_postprocessing)
+# and the concentration fields saved in data_output/cfields, so no snapshot
+# files are needed; snapshot_file (e.g. 'output/snap-{}-{}.csv') writes them
+# anyway, in the PAR2 format. The breakthrough curves (result-{}.csv) are not
+# computed. The fields are the ones cfield_postprocessing writes, so the
+# post-processing of section 6 (plotinfo.postprocessing) starts from them when
+# tstep, block_x and block_y are the ones of plotinfo (tstep defaults to the
+# snapshot steps of config.yaml, which may be more).
+#
+# binning, cellindex, cfield_store, ftl_reader and parallel are modules of the
+# UncertaintyQuantification&RiskAnalysis folder: run rwpt.py from the folder
+# where all the files were copied (see README.md), or add that folder to
+# sys.path first.
+
+CONFIG_FILE = 'config.yaml'
+
+
+def snapshot_steps(config):
+    snapshot = config['output'].get('snapshot', {})
+    if 'steps' in snapshot:
+        return np.asarray(snapshot['steps'])
+    return np.arange(0, config['simulation']['steps'] + 1, snapshot.get('skip', 1))
+
+
+class RandomWalk:
+    def __init__(self, config=CONFIG_FILE, block_x=1, block_y=1, tstep=None, seed=0, snapshot_file=None):
+        if isinstance(config, str):
+            with open(config) as f:
+                config = yaml.safe_load(f)
+        self.nx, self.ny = config['grid']['dimension'][:2]
+        self.dx, self.dy, self.dz = config['grid']['cell size']
+        self.Lx, self.Ly = self.nx*self.dx, self.ny*self.dy
+        physics = config['physics']
+        self.porosity = physics['porosity']
+        self.Dm = physics['molecular diffusion']
+        self.alpha_l = physics['longitudinal dispersivity']
+        self.alpha_t = physics['transverse dispersivity']
+        self.ftl_file = physics['velocity']['file']
+        particles = config['simulation']['particles']
+        self.particle_n = particles['N']
+        self.start = np.array([particles['start']['p1'], particles['start']['p2']], dtype=float)
+        self.dt = config['simulation']['dt']
+        self.tstep = np.sort(np.asarray(tstep if tstep is not None else snapshot_steps(config)))
+        self.block_x = block_x
+        self.block_y = block_y
+        self.seed = seed
+        self.snapshot_file = snapshot_file
+
+    def velocity(self, real):
+        # face velocities: vx[j, i] on the left face of cell (j, i), vx[j, i+1]
+        # on its right face, vy[j, i] and vy[j+1, i] the same along y
+        fluxes = read_ftl(self.ftl_file.format(real), (self.ny, self.nx), ('X', 'Y'))
+        vx = np.zeros((self.ny, self.nx + 1))
+        vx[:, 1:-1] = fluxes['X'][:, :-1]/(self.dy*self.dz*self.porosity)
+        # the fixed-head boundaries take the velocity of the next face
+        vx[:, 0] = vx[:, 1]
+        vx[:, -1] = vx[:, -2]
+        vy = np.zeros((self.ny + 1, self.nx))
+        vy[1:-1] = fluxes['Y'][:-1]/(self.dx*self.dz*self.porosity)
+        return vx, vy
+
+    def drift(self, vx, vy):
+        # div D at the cell centres
+        ux = (vx[:, :-1] + vx[:, 1:])/2
+        uy = (vy[:-1] + vy[1:])/2
+        speed = np.hypot(ux, uy)
+        ratio = np.divide(self.alpha_l - self.alpha_t, speed, out=np.zeros_like(speed), where=speed > 0)
+        isotropic = self.alpha_t*speed + self.Dm
+        dxx, dyy, dxy = isotropic + ratio*ux**2, isotropic + ratio*uy**2, ratio*ux*uy
+        return (np.gradient(dxx, self.dx, axis=1) + np.gradient(dxy, self.dy, axis=0),
+                np.gradient(dxy, self.dx, axis=1) + np.gradient(dyy, self.dy, axis=0))
+
+    def _save_snapshot(self, real, step, x, y, z):
+        np.savetxt(self.snapshot_file.format(real, step), np.column_stack((np.arange(len(x)), x, y, z)),
+                   fmt=('%d', '%.6f', '%.6f', '%.6f'), delimiter=',', header='id,x coord,y coord,z coord',
+                   comments='')
+
+    def simulate(self, real):
+        # moves the particles of one realization, returns the (nt, Ly/block_y,
+        # Lx/block_x) particle counts and the number of particles not binned
+        # in every snapshot
+        vx, vy = self.velocity(real)
+        drift_x, drift_y = (d.ravel() for d in self.drift(vx, vy))
+        vx_left, vx_right = vx[:, :-1].ravel(), vx[:, 1:].ravel()
+        vy_low, vy_up = vy[:-1].ravel(), vy[1:].ravel()
+
+        rng = np.random.default_rng([self.seed, real])
+        x, y, z = rng.uniform(self.start[0], self.start[1], (self.particle_n, 3)).T.copy()
+        # only the particles still in the domain are moved
+        active = np.arange(self.particle_n)
+        xa, ya = x.copy(), y.copy()
+
+        dt = self.dt
+        counts = []
+        outside = np.zeros(len(self.tstep), dtype=np.intp)
+        step = 0
+        for k, target in enumerate(self.tstep):
+            for step in range(step, target):
+                i = np.minimum((xa/self.dx).astype(np.intp), self.nx - 1)
+                j = np.minimum((ya/self.dy).astype(np.intp), self.ny - 1)
+                cell = j*self.nx + i
+                fx = xa/self.dx - i
+                fy = ya/self.dy - j
+                ux = (1 - fx)*vx_left[cell] + fx*vx_right[cell]
+                uy = (1 - fy)*vy_low[cell] + fy*vy_up[cell]
+
+                speed = np.hypot(ux, uy)
+                moving = speed > 0
+                ex = np.divide(ux, speed, out=np.ones_like(speed), where=moving)
+                ey = np.divide(uy, speed, out=np.zeros_like(speed), where=moving)
+                xi_l, xi_t = rng.standard_normal((2, len(xa)))
+                xi_l *= np.sqrt(2*(self.alpha_l*speed + self.Dm)*dt)
+                xi_t *= np.sqrt(2*(self.alpha_t*speed + self.Dm)*dt)
+
+                xa += (ux + drift_x[cell])*dt + xi_l*ex - xi_t*ey
+                ya += (uy + drift_y[cell])*dt + xi_l*ey + xi_t*ex
+                np.abs(ya, out=ya)
+                np.minimum(ya, 2*self.Ly - ya, out=ya)
+
+                left = (xa < 0) | (xa >= self.Lx)
+                if left.any():
+                    x[active[left]] = xa[left]
+                    y[active[left]] = ya[left]
+                    active, xa, ya = active[~left], xa[~left], ya[~left]
+            step = target
+
+            x[active] = xa
+            y[active] = ya
+            frame, outside[k] = bin_particles(x, y, self.Lx, self.Ly, self.block_x, self.block_y)
+            counts.append(frame)
+            if self.snapshot_file is not None:
+                self._save_snapshot(real, target, x, y, z)
+        return np.array(counts), outside
+
+    def run(self, real, storage='dense'):
+        counts, outside = self.simulate(real)
+        save_cfield(real, counts, self.particle_n, storage)
+        return outside
+
+
+def rwpt_simulation(realizations, config_file=CONFIG_FILE, n_workers=1, storage='dense', block_x=1, block_y=1,
+                    tstep=None, seed=0, snapshot_file=None, chunksize=None, on_complete=None, should_stop=None):
+    # runs the realizations and saves their concentration fields, returns
+    # {real: particles not binned in every snapshot}; on_complete(real) and
+    # should_stop(real) as in transport.transport_simulation, e.g. the ones of
+    # a convergence.ConvergenceMonitor
+    walk = RandomWalk(config_file, block_x, block_y, tstep, seed, snapshot_file)
+    os.makedirs(CFIELD_DIR, exist_ok=True)
+    if snapshot_file is not None:
+        os.makedirs(os.path.dirname(snapshot_file) or '.', exist_ok=True)
+    outside = run_realizations(partial(walk.run, storage=storage), realizations,
+                               n_workers, chunksize, 'rwpt', on_complete=on_complete, should_stop=should_stop)
+    # the cell index holds the previous fields of these realizations
+    invalidate_cells(sorted(outside))
+    for real in sorted(outside):
+        if outside[real].any():
+            print(f'realization no. {real}: {outside[real].sum()} particle positions outside the domain '
+                  f'(in {np.count_nonzero(outside[real])} of {len(walk.tstep)} snapshots) were not binned')
+    return dict(sorted(outside.items()))
@@ -0,0 +1,115 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import yaml
+
+# PAR2 transport simulations of the Monte Carlo realizations.
+#
+# config.yaml is parsed once; the configuration of every realization is
+# rendered in memory by replacing '{}' with the realization number in all its
+# strings (velocity file, result and snapshot files) and written to a file of
+# its own (tmp/config-{real}.yaml), so several PAR2 processes can run at the
+# same time. At most n_workers runs are in flight; a failed run (non-zero exit
+# code or no result file) is retried up to `retries` times and then reported.
+# An exception, e.g. a missing PAR2 executable or an error of on_complete,
+# counts as a failed attempt as well and its message goes into the report.
+#
+# on_complete(real) is called as soon as a realization finished, while the
+# others keep running, e.g. to bin its snapshots right away
+# (plotinfo.process_realization), and should_stop(real) can end the Monte
+# Carlo loop early (e.g. ConvergenceMonitor.should_stop).
+
+CONFIG_FILE = 'config.yaml'
+
+
+def load_config(config_file=CONFIG_FILE):
+    with open(config_file) as f:
+        return yaml.safe_load(f)
+
+
+def realization_config(config, real):
+    if isinstance(config, str):
+        return config.replace('{}', str(real))
+    if isinstance(config, dict):
+        return {key: realization_config(value, real) for key, value in config.items()}
+    if isinstance(config, list):
+        return [realization_config(value, real) for value in config]
+    return config
+
+
+def run_par2(exe, config, config_path, log_path):
+    result = config['output']['csv']['file']
+    # a result file left by an earlier run must not count as a success
+    if os.path.exists(result):
+        os.remove(result)
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    with open(log_path, 'w') as log:
+        process = subprocess.run([exe, config_path], stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode == 0 and os.path.exists(result)
+
+
+def transport_simulation(realizations, config_file=CONFIG_FILE, exe='par2.exe', n_workers=2, retries=1,
+                         on_complete=None, should_stop=None, config_dir='tmp'):
+    # returns {real: True/False}, False for the runs that failed every attempt
+    exe = os.path.abspath(exe) if os.path.exists(exe) else exe
+    config = load_config(config_file)
+    os.makedirs(config_dir, exist_ok=True)
+    for output in config['output'].values():
+        os.makedirs(os.path.dirname(output['file']) or '.', exist_ok=True)
+
+    # failed runs go back to the front of the queue
+    pending = list(realizations)[::-1]
+    attempts = {}
+    errors = {}
+    running = {}
+    results = {}
+    stop = False
+    with ThreadPoolExecutor(n_workers) as pool:
+        while True:
+            while not stop and pending and len(running) < n_workers:
+                real = pending.pop()
+                attempts[real] = attempts.get(real, 0) + 1
+                real_config = realization_config(config, real)
+                future = pool.submit(run_par2, exe, real_config, f'{config_dir}/config-{real}.yaml',
+                                     f'{config_dir}/par2-{real}.log')
+                running[future] = real
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                real = running.pop(future)
+                try:
+                    success = future.result()
+                    if success:
+                        if on_complete is not None:
+                            on_complete(real)
+                        if should_stop is not None and should_stop(real):
+                            stop = True
+                except Exception as error:
+                    success = False
+                    errors[real] = f'{type(error).__name__}: {error}'
+                else:
+                    errors.pop(real, None)
+                reason = errors[real] if real in errors else f'see {config_dir}/par2-{real}.log'
+                if success:
+                    results[real] = True
+                    os.remove(f'{config_dir}/config-{real}.yaml')
+                    print(f'transport: realization no. {real} done')
+                elif attempts[real] <= retries:
+                    print(f'transport: realization no. {real} failed, retrying ({reason})')
+                    pending.append(real)
+                else:
+                    results[real] = False
+                    print(f'TRANSPORT SIMULATION ERROR, realization no. {real} failed '
+                          f'{attempts[real]} times ({reason})')
+
+    failed = sorted(real for real, success in results.items() if not success)
+    print(f'{len(results) - len(failed)} transport simulations done, {len(failed)} failed' +
+          (f': {failed}' if failed else ''))
+    for real in failed:
+        if real in errors:
+            print(f'  realization no. {real}: {errors[real]}')
+    return dict(sorted(results.items()))
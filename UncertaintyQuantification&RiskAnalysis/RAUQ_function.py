@@ -1,24 +1,35 @@
 import numpy as np
-import pandas as pd
-from scipy.optimize import curve_fit
-import scipy
-from scipy import stats
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.ticker import LinearLocator, FuncFormatter, FormatStrFormatter
-from copy import copy
 import os
-import pickle
+import zipfile
+from functools import partial
+
+from accumulators import RiskAccumulator, RunningStats, ThresholdSweep
+from binning import bin_snapshots, grid_shape
+from breakthrough import breakthrough_statistics, load_results
+from cellindex import CellIndex, INDEX_FILE, invalidate as invalidate_cells
+from cfield_store import cfield_file, cfield_shape, iter_cfield_frames, load_cfield, load_cfield_frame, save_cfield
+from convergence import ConvergenceMonitor
+from ensemble import create_ensemble, open_ensemble
+from exceedance import Exceedance
+from ftl_reader import load_flux_ensemble
+from instrumentation import Profiler, profiled
+from kfields import KFieldStore
+from referencepoints import concatenate, edge_points, load_table, maxconc_points, save_table
+from parallel import run_realizations
+from snapshots import load_realization, snapshot_time
+from stages import StageRunner
+
+# matplotlib, scipy and rendering.py are only imported by the plotting methods,
+# the post-processing stages (and the workers running them) need NumPy only;
+# the figures folder is created by the first saved figure
+
 
-path = 'figures/'
-if not os.path.exists(path):
-    os.makedirs(path)
-    
 class plotinfo:
     def __init__(self, n_realization, Kg, Lx, Ly, block_x, block_y, lambda_x, lambda_y, 
                  source_xl, source_xu, source_yl, source_yu, 
                  target_xl, target_xu, target_yl, target_yu,
-                 mcl, observation_wells, tstep, dt):
+                 mcl, observation_wells, tstep, dt, n_workers=1, chunksize=None, snapshot_cache=True, storage='dense',
+                 profile=False):
         
         self.n_realization = n_realization
         self.Kg = Kg
@@ -41,13 +52,70 @@ class plotinfo:
         self.tstep = tstep
         self.nt = len(tstep)
         self.dt = dt
+        self.n_workers = n_workers
+        self.chunksize = chunksize
+        self.snapshot_cache = snapshot_cache
+        self.storage = storage
         
-        self.kfields = np.load('Kfileds_Hydrogen.npy')
-        self.kmax = np.ceil(np.max(self.kfields))
-        self.kmin = np.floor(np.min(self.kfields))
+        # profile=True (or an instrumentation.Profiler, e.g. with a report file)
+        # records time, I/O and memory of every stage and realization
+        self.profiler = Profiler() if profile is True else (profile or None)
+
+        # opened lazily, the K-fields are only needed for plotting
+        self.kfields = KFieldStore('Kfileds_Hydrogen.npy')
+
+    @property
+    def kmax(self):
+        return np.ceil(self.kfields.max)
+
+    @property
+    def kmin(self):
+        return np.floor(self.kfields.min)
+
+    def _run(self, func, realizations, label):
+        return run_realizations(func, realizations, self.n_workers, self.chunksize, label,
+                                profiler=self.profiler)
+
+    def _chunks(self):
+        # contiguous blocks of realizations, one per worker, for the stages
+        # that accumulate ensemble statistics and merge them afterwards
+        n_chunks = max(1, min(self.n_workers or os.cpu_count(), self.n_realization))
+        return np.array_split(np.arange(self.n_realization), n_chunks)
+
+    def _run_chunks(self, func, label):
+        chunks = self._chunks()
+        results = run_realizations(partial(func, chunks=chunks), range(len(chunks)), self.n_workers, 1,
+                                   label, 'block', self.profiler)
+        return [results[k] for k in range(len(chunks))]
         
 
+    @profiled
+    def postprocessing(self, *stages, force=False):
+        # runs the post-processing stages (all by default) whose parameters or
+        # inputs changed since their last run, see stages.py
+        StageRunner(self).run(*stages, force=force)
+
+    def convergence_monitor(self, **kwargs):
+        # monitor to pass to the simulation drivers, which stop starting new
+        # realizations once the estimates converged:
+        # transport_simulation(..., on_complete=monitor.on_complete, should_stop=monitor.should_stop)
+        return ConvergenceMonitor(self, **kwargs)
+
+    def convergence(self, **kwargs):
+        # replays the processed realizations in order through a ConvergenceMonitor
+        # (tolerance, confidence, min_realizations, patience, quantities)
+        monitor = ConvergenceMonitor(self, **kwargs)
+        for real in range(self.n_realization):
+            monitor.update_realization(real)
+        monitor.report()
+        return monitor
+
+    @profiled
     def logkfield(self, filename, real_n):
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import LinearLocator
+        from rendering import figure_file
+
         kfield = self.kfields[real_n]
         fig, ax = plt.subplots(figsize=(7,5))
         img = ax.imshow(kfield, cmap='jet', extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
@@ -86,454 +154,351 @@ class plotinfo:
 
         plt.legend(fontsize=12)
         plt.tight_layout()
-        plt.savefig(f'figures/{filename}.png',dpi=100, bbox_inches='tight')
+        plt.savefig(figure_file(filename),dpi=100, bbox_inches='tight')
         plt.show()
 
-    def cfield_postprocessing(self):
-        cell_n = (self.Ly, self.Lx)
-        block_s = (self.block_y, self.block_x)
-        name_datafiles = [f'output/snap-{i}-{j}.csv' for i in np.arange(self.n_realization) for j in self.tstep]
-        data = pd.read_csv(name_datafiles[0])
-        particle_n = data.count()[0]
-        
-        for real in range(self.n_realization):
-            print(f'realization no. {real}')
-            current_percent = 0
-            datafiles = name_datafiles[real*self.nt:real*self.nt+self.nt]
-            field_c = np.zeros((len(datafiles), cell_n[0], cell_n[1]))
-            data_arrays = np.zeros((len(datafiles), 2, particle_n))
-
-            for i in range(len(datafiles)):
-                coordinates = np.floor(pd.read_csv(datafiles[i]).to_numpy('float').T[1:3]).astype(int)
-                for j in range(particle_n):
-                    field_c[i, coordinates[1,j]-1, coordinates[0,j]-1] += 1/particle_n
-
-                if i/(len(datafiles)-1)*100 >= current_percent:
-                    print(f'processing {current_percent}%')
-                    current_percent += 50
-
-            np.save(f'data_output/cfields/cfield_{real}', field_c)
-        
+    def cfield_valid(self, real):
+        try:
+            shape = cfield_shape(real)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return False
+        if shape != (self.nt,) + grid_shape(self.Lx, self.Ly, self.block_x, self.block_y):
+            return False
+        # a field binned before its transport run was done again is outdated,
+        # one binned right after the run (process_realization) is kept
+        particles = snapshot_time(real, self.tstep)
+        path = cfield_file(real, 'dense' if os.path.exists(cfield_file(real)) else 'counts')
+        return particles is None or os.path.getmtime(path) >= particles
+
+    def _cfield_realization(self, real):
+        data_arrays = load_realization(real, self.tstep, cache=self.snapshot_cache)
+        particle_n = data_arrays.shape[2]
+
+        counts, outside = bin_snapshots(data_arrays, self.Lx, self.Ly, self.block_x, self.block_y)
+        save_cfield(real, counts, particle_n, self.storage)
+        return outside
+
+    @profiled
+    def cfield_postprocessing(self, resume=True):
+        realizations = range(self.n_realization)
+        if resume:
+            realizations = [real for real in realizations if not self.cfield_valid(real)]
+            skipped = self.n_realization - len(realizations)
+            if skipped:
+                print(f'{skipped} realizations already processed, skipped')
+        else:
+            # the fields saved by rwpt.py have no snapshots to bin again
+            realizations = [real for real in realizations
+                            if snapshot_time(real, self.tstep) is not None or not self.cfield_valid(real)]
+            skipped = self.n_realization - len(realizations)
+            if skipped:
+                print(f'{skipped} realizations without snapshot files (rwpt.py) kept')
+        # without snapshot files (rwpt.py) there is nothing to bin
+        missing = [real for real in realizations if snapshot_time(real, self.tstep) is None]
+        if missing:
+            shape = (self.nt,) + grid_shape(self.Lx, self.Ly, self.block_x, self.block_y)
+            raise ValueError(f'realizations {missing} have neither snapshot files nor a concentration field of '
+                             f'shape {shape}; run rwpt.rwpt_simulation with the tstep, block_x and block_y '
+                             f'of plotinfo, or the transport simulations')
+
+        outside = self._run(self._cfield_realization, realizations, 'cfield')
+        for real in sorted(outside):
+            self._report_outside(real, outside[real])
+        invalidate_cells(sorted(outside))
+
+    def process_realization(self, real, cell_index=False):
+        # bins one realization as soon as its transport run finished (on_complete
+        # of transport.transport_simulation); cfield_postprocessing then skips it.
+        # With cell_index it is also added to the cell index, created if needed
+        self._report_outside(real, self._cfield_realization(real))
+        if cell_index:
+            self._cell_index(mode='r+').add_realization(real)
+        else:
+            invalidate_cells(real)
+
+    def _report_outside(self, real, outside):
+        if outside.any():
+            print(f'realization no. {real}: {outside.sum()} particle positions outside the domain '
+                  f'(in {np.count_nonzero(outside)} of {self.nt} snapshots) were not binned')
+
+    def _referencepoints_chunk(self, k, chunks, c0):
+        maxconc, edge = [], []
+        for real in chunks[k]:
+            field_c = load_cfield(real)
+            maxconc.append((real, maxconc_points(field_c, c0, self.mcl, self.lambda_x, self.dt)))
+            edge.append((real, edge_points(field_c, self.Lx, self.lambda_x, self.dt)))
+        return maxconc, edge
+
+    @profiled
     def referencepoints_postprocessing(self):
-        field_c = np.load(f'data_output/cfields/cfield_0.npy')
+        field_c = load_cfield(0, mmap_mode='r')
         c0 = field_c[0,:,:-2].max()
 
-        for real in range(self.n_realization):
-            field_c = np.load(f'data_output/cfields/cfield_{real}.npy')
-
-            maxconc_data = {'tstep': [], 'x_coord': [], 'y_coord': [], 'conc': []}
-            for j in range(self.nt):
-                if field_c[j,:,:-self.lambda_x].max() <= c0*self.mcl:
-                    break
-                else:
-                    coordinates = np.where( field_c[j,:,:-self.lambda_x]==field_c[j,:,:-self.lambda_x].max())        
-                    for k in range(len(coordinates[0])):
-                        maxconc_data['tstep'].append(self.dt*j)
-                        maxconc_data['y_coord'].append(coordinates[0][k])
-                        maxconc_data['x_coord'].append(coordinates[1][k])
-                        maxconc_data['conc'].append(field_c[j][maxconc_data['y_coord'][-1],maxconc_data['x_coord'][-1]])
-
-            maxconc_data['tstep'] = np.array(maxconc_data['tstep'])
-            maxconc_data['y_coord'] = np.array(maxconc_data['y_coord'])
-            maxconc_data['x_coord'] = np.array(maxconc_data['x_coord'])
-            maxconc_data['conc'] = np.array(maxconc_data['conc'])
-            pickle.dump(maxconc_data, open(f'data_output/referencepoints/maxconc_{real}.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)    
-
-            edge_data = {'tstep': [], 'x_coord': [], 'y_coord': []}
-            for j in range(self.nt):
-                edge_x = np.amax(np.argwhere(field_c[j])[:,1])
-                if edge_x >= self.Lx-self.lambda_x:
-                    break
-                edge_y = np.argmax(field_c[j][:,edge_x])
-                edge_data['tstep'].append(self.dt*j)
-                edge_data['x_coord'].append(edge_x)
-                edge_data['y_coord'].append(edge_y)
-
-            edge_data['tstep'] = np.array(edge_data['tstep'])
-            edge_data['x_coord'] = np.array(edge_data['x_coord'])    
-            edge_data['y_coord'] = np.array(edge_data['y_coord'])
-            pickle.dump(edge_data, open(f'data_output/referencepoints/edge_{real}.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+        maxconc, edge = [], []
+        for chunk_maxconc, chunk_edge in self._run_chunks(partial(self._referencepoints_chunk, c0=c0), 'referencepoints'):
+            maxconc += chunk_maxconc
+            edge += chunk_edge
+        save_table('maxconc', concatenate(maxconc))
+        save_table('edge', concatenate(edge))
         
+    def _cfield_ensemble_chunk(self, k, chunks):
+        cfield_all = open_ensemble(mode='r+')
+        cfield_stats = RunningStats()
+        for i in chunks[k]:
+            field_c = load_cfield(i)
+            cfield_all[i] = field_c
+            cfield_stats.update(field_c)
+        cfield_all.flush()
+        return cfield_stats
+
+    @profiled
     def cfield_ensemble_postprocessing(self):
-        cfield_all = []
-        for i in range(self.n_realization):
-            cfield_all.append(np.load(f'data_output/cfields/cfield_{i}.npy'))
-        cfield_all = np.asarray(cfield_all)
-        np.save(f'data_output/cfields/cfield_all.npy', cfield_all)
-        cfield_ave = cfield_all.mean(axis=0)
-        np.save(f'data_output/cfields/cfield_ensemble.npy', cfield_ave)
-        cfield_var = cfield_all.var(axis=0)
-        np.save(f'data_output/cfields/cfield_ensemble_v.npy', cfield_var)
+        field_shape = (self.nt,) + grid_shape(self.Lx, self.Ly, self.block_x, self.block_y)
+        create_ensemble(self.n_realization, field_shape).flush()
+
+        cfield_stats = RunningStats()
+        for stats in self._run_chunks(self._cfield_ensemble_chunk, 'cfield ensemble'):
+            cfield_stats.merge(stats)
+        np.save(f'data_output/cfields/cfield_ensemble.npy', cfield_stats.mean)
+        np.save(f'data_output/cfields/cfield_ensemble_v.npy', cfield_stats.var)
         
-    def cfield(self, filename, real_n, time_index, plume_edge, max_conc):
-        field_c = np.load(f'data_output/cfields/cfield_{real_n}.npy')
-        risk_var = np.load('data_output/cfields/cfield_ensemble_v.npy', )
-        if not real_n == 'ensemble':
-            kfield = self.kfields[real_n]
-            alpha_v = 0.7
-            maxconc = pickle.load(open(f'data_output/referencepoints/maxconc_{real_n}.pkl', 'rb'))
-            edge = pickle.load(open(f'data_output/referencepoints/edge_{real_n}.pkl', 'rb'))
-            ylabel = r'$c$'
-        else:
-            alpha_v = 1
-            ylabel = r'$\left< c \right>$'
-            
-        c0 = field_c[0].max()
-
-        for i in time_index:
-            fig, ax = plt.subplots(figsize=(7,5))
-            cmap = copy(plt.get_cmap('Greens'))
-            def fmt(x, pos):
-                a, b = '{:.0e}'.format(x).split('e')
-                b = int(b)
-                return r'${} \times 10^{{{}}}$'.format(a, b)
-            if not real_n == 'ensemble':
-                img = ax.imshow(kfield, cmap='jet', extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                                vmin=self.kmin, vmax=self.kmax)
-            img = ax.imshow(field_c[i,:,:-1]/c0, cmap=cmap, 
-                            extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], vmin=0, vmax=1e0, alpha=alpha_v)
-            cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-            cbar.ax.tick_params(labelsize=14)
-            cbar.ax.set_ylabel(ylabel, fontsize=25, fontname='Arial', labelpad=10)
-            cbar.solids.set_edgecolor("face")
-            ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                       color='k', marker='^' ,s=50)            
-            
-            if not real_n == 'ensemble':
-                if plume_edge:
-                    edge_index = edge['tstep']//self.dt == i
-                    edge_indexes = edge['tstep']//self.dt <= i
-
-                    ax.scatter(edge['x_coord'][edge_index]/self.lambda_x, edge['y_coord'][edge_index]/self.lambda_y,
-                               s=80, c='b', marker='X', linewidths=.01, alpha=0.8, label='plume edge')
-                    ax.plot(edge['x_coord'][edge_indexes]/self.lambda_x, edge['y_coord'][edge_indexes]/self.lambda_y,
-                            c='b', linestyle=':', alpha=0.8)
-                    plt.legend(loc=2, fontsize=12)
-
-                if max_conc:
-                    maxconc_index = maxconc['tstep']//self.dt == i
-                    maxconc_indexes = maxconc['tstep']//self.dt <= i
-
-                    ax.scatter(maxconc['x_coord'][maxconc_index]/self.lambda_x, maxconc['y_coord'][maxconc_index]/self.lambda_y,
-                               s=80, c='r', marker='X', linewidths=.01, alpha=0.8, label='max C')
-                    ax.scatter(maxconc['x_coord'][maxconc_indexes]/self.lambda_x, maxconc['y_coord'][maxconc_indexes]/self.lambda_y,
-                               s=30, c='r', marker='X', linewidths=.01, alpha=0.5)
-                    plt.legend(loc=2, fontsize=12)
-
-            ax.xaxis.set_major_locator(LinearLocator(5))
-            ax.xaxis.set_minor_locator(LinearLocator(21))
-            ax.yaxis.set_major_locator(LinearLocator(5))
-            ax.yaxis.set_minor_locator(LinearLocator(21))
-
-            rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                      (self.target_xu-self.target_xl)/self.lambda_x, 
-                                      (self.target_yu-self.target_yl)/self.lambda_y, 
-                                      fc='k', fill=None, linewidth=1.5)
-            plt.gca().add_patch(rectangle2)       
-
-            plt.xlim(0,self.Lx/self.lambda_x)
-            plt.ylim(0,self.Ly/self.lambda_y)
-            plt.xticks(fontsize=15, fontname='Arial')
-            plt.yticks(fontsize=15, fontname='Arial')
-            plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-            plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-
-            plt.text(5/self.lambda_x, 5/self.lambda_y, f'$t={i*self.dt}$', fontsize=15, color='k')
-            plt.tight_layout()
-            plt.savefig(f'figures/{filename}_{i}.png',dpi=200, bbox_inches='tight')
-            
-            if real_n == 'ensemble':
-                fig, ax = plt.subplots(figsize=(7,5))
-                cmap = copy(plt.get_cmap('Purples'))
+    def _cell_index(self, mode='r'):
+        shape = grid_shape(self.Lx, self.Ly, self.block_x, self.block_y) + (self.n_realization, self.nt)
+        if mode != 'r' and (not os.path.exists(INDEX_FILE) or np.load(INDEX_FILE, mmap_mode='r').shape != shape):
+            return CellIndex.create(self.n_realization, (self.nt,) + shape[:2])
+        return CellIndex(mode=mode)
+
+    def _cellindex_chunk(self, k, chunks, block=8):
+        # blocks of realizations are written at once, in longer contiguous runs
+        index = CellIndex(mode='r+')
+        for reals in np.array_split(chunks[k], max(1, -(-len(chunks[k])//block))):
+            if len(reals):
+                index.add(reals, [load_cfield(real) for real in reals])
+
+    @profiled
+    def cellindex_postprocessing(self, resume=True):
+        # cell-major copy of the concentration fields for time series queries
+        # (cell_index), see cellindex.py
+        index = self._cell_index(mode='r+')
+        realizations = index.missing() if resume else np.arange(self.n_realization)
+        if not len(realizations):
+            print('cell index complete')
+            return
+        n_chunks = max(1, min(self.n_workers or os.cpu_count(), len(realizations)))
+        chunks = np.array_split(realizations, n_chunks)
+        run_realizations(partial(self._cellindex_chunk, chunks=chunks), range(n_chunks), self.n_workers, 1,
+                         'cell index', 'block', self.profiler)
+
+    def cell_index(self):
+        # breakthrough curves, peak concentrations and arrival times at any
+        # cells: cell_index().series([(x, y), ...]), .peak(...), .arrival(...)
+        return CellIndex()
+
+    def _render(self, method, **job):
+        # frames of one plot, split across the workers when running in parallel
+        frames = job.get('time_index')
+        if self.n_workers == 1 or frames is None or len(frames) < 2:
+            getattr(self, method)(**job)
+            return
+        chunks = np.array_split(np.asarray(frames), min(self.n_workers or os.cpu_count(), len(frames)))
+        self.render_batch(method, [dict(job, time_index=list(chunk)) for chunk in chunks])
+
+    def _render_job(self, k, method, jobs):
+        from rendering import use_agg
+        use_agg()
+        getattr(self, method)(**jobs[k])
+
+    @profiled
+    def render_batch(self, method, jobs):
+        # render many plots on the process pool, e.g.
+        # render_batch('cfield', [dict(filename=f'cfield_{r}', real_n=r, time_index=[0, 10], plume_edge=True, max_conc=True) for r in range(10)])
+        if not method.startswith('_'):
+            method = f'_{method}_frames'
+        run_realizations(partial(self._render_job, method=method, jobs=jobs), range(len(jobs)),
+                         self.n_workers, 1, 'render', 'job', self.profiler)
+
+    def _map_frames(self, field, real_n, time_index, variance=False):
+        # figure layers (cmap, ylabel, alpha, background) of a cfield/riskfield
+        # map and a generator of its (i, data, vmin, vmax) frames, which reads
+        # one time step at a time
+        if field not in ('cfield', 'riskfield'):
+            raise ValueError(f'unknown field {field}, use cfield or riskfield')
+        if variance and not real_n == 'ensemble':
+            raise ValueError('the variance maps are only available for the ensemble')
+
+        if variance:
+            if field == 'cfield':
+                field_var = np.load('data_output/cfields/cfield_ensemble_v.npy', mmap_mode='r')
+                columns = slice(None, -1)
                 ylabel = r'$\sigma^2_{c}$'
-                def fmt(x, pos):
-                    a, b = '{:.0e}'.format(x).split('e')
-                    b = int(b)
-                    return r'${} \times 10^{{{}}}$'.format(a, b)
-                img = ax.imshow(risk_var[i,:,:-1], cmap=cmap, 
-                                extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                                vmin=0, vmax=np.max(risk_var[i,:,:-self.lambda_x]), alpha=alpha_v)
-                cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-                cbar.ax.tick_params(labelsize=14)
-                cbar.ax.set_ylabel(ylabel, fontsize=25, fontname='Arial', labelpad=10)
-                cbar.solids.set_edgecolor("face")
-                ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                           color='k', marker='^' ,s=50)
-
-                ax.xaxis.set_major_locator(LinearLocator(5))
-                ax.xaxis.set_minor_locator(LinearLocator(21))
-                ax.yaxis.set_major_locator(LinearLocator(5))
-                ax.yaxis.set_minor_locator(LinearLocator(21))
-
-                rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                          (self.target_xu-self.target_xl)/self.lambda_x, 
-                                          (self.target_yu-self.target_yl)/self.lambda_y, 
-                                          fc='k', fill=None, linewidth=1.5)
-                plt.gca().add_patch(rectangle2)       
-
-                plt.xlim(0,self.Lx/self.lambda_x)
-                plt.ylim(0,self.Ly/self.lambda_y)
-                plt.xticks(fontsize=15, fontname='Arial')
-                plt.yticks(fontsize=15, fontname='Arial')
-                plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-
-                plt.text(5/self.lambda_x, 5/self.lambda_y, f'$t={i*self.dt}$', fontsize=15, color='k')
-                plt.tight_layout()
-                plt.savefig(f'figures/{filename}_v_{i}.png',dpi=200, bbox_inches='tight')            
-                ylabel = r'$\left< c \right>$'
-            
+            else:
+                field_var = np.load('data_output/risk_ensemble_v.npy', mmap_mode='r')
+                columns = slice(None)
+                ylabel = r'$\sigma^2_{\Psi}$'
+            return (('Purples', ylabel, 1, None),
+                    ((i, field_var[i][:,columns], 0, np.max(field_var[i][:,:-self.lambda_x])) for i in time_index))
+
+        if field == 'riskfield' and real_n == 'ensemble':
+            field_maxrisk = np.load('data_output/risk_ensemble.npy', mmap_mode='r')
+            return ('Reds', r'$\left<\Psi\right>$', 1, None), ((i, field_maxrisk[i], 0, 1) for i in time_index)
+
+        c0 = load_cfield_frame(real_n, 0).max()
+        frames = zip(time_index, iter_cfield_frames(real_n, time_index))
+        if field == 'cfield':
+            if real_n == 'ensemble':
+                layers = ('Greens', r'$\left< c \right>$', 1, None)
+            else:
+                layers = ('Greens', r'$c$', 0.7, self.kfields[real_n])
+            return layers, ((i, field_c[:,:-1]/c0, 0, 1e0) for i, field_c in frames)
+
+        def maxrisk_frames():
+            for i, field_c in frames:
+                field_maxrisk = np.where(field_c >= (self.mcl*c0), field_c/(self.mcl*c0), 0)
+                yield i, field_maxrisk, 1, np.ceil(field_maxrisk[:,:-8].max())
+        return ('Reds', r'$\rm{max}$ $c~/~\rm{mcl}$', 0.7, self.kfields[real_n]), maxrisk_frames()
+
+    def _plume_markers(self, figure, real_n, plume_edge, max_conc):
+        # plume edge and maximum concentration tracks of a realization map,
+        # returns the function moving them to time step i
+        if real_n == 'ensemble' or not (plume_edge or max_conc):
+            return lambda i: None
+        from rendering import PlumeMarkers
+        markers = PlumeMarkers(figure.ax, plume_edge, max_conc)
+        maxconc = load_table('maxconc', real_n)
+        edge = load_table('edge', real_n)
+        return lambda i: markers.update(self, i, edge, maxconc)
+
+    def _save_frames(self, filename, layers, frames, plume=None):
+        from rendering import MapFigure
+        with MapFigure(self, *layers) as figure:
+            markers = self._plume_markers(figure, *plume) if plume else lambda i: None
+            for i, data, vmin, vmax in frames:
+                figure.update(data, vmin, vmax, i*self.dt)
+                markers(i)
+                figure.save(f'{filename}_{i}')
+
+    def _cfield_frames(self, filename, real_n, time_index, plume_edge, max_conc):
+        self._save_frames(filename, *self._map_frames('cfield', real_n, time_index),
+                          plume=(real_n, plume_edge, max_conc))
+        if real_n == 'ensemble':
+            self._save_frames(f'{filename}_v', *self._map_frames('cfield', real_n, time_index, variance=True))
 
-    def rrfield_postprocessing(self):
-        cfield_all = np.load('data_output/cfields/cfield_all.npy')
-        reliability_field = np.zeros(cfield_all.shape)
-        resilience_field = np.zeros((self.n_realization, self.Ly, self.Lx))
-        for real_n in range(self.n_realization):
-            field_c = cfield_all[real_n]
-            c0 = field_c[0].max()
-            reliability_field[real_n] = np.where(field_c >= (self.mcl*c0), 1, 0)
-            resilience_field[real_n] = np.sum(reliability_field[real_n], axis=0)*self.dt
-        risk_ensemble = reliability_field.mean(axis=0)
-        risk_var = reliability_field.var(axis=0)
-        np.save('data_output/reliability_field', reliability_field)
-        np.save('data_output/risk_ensemble', risk_ensemble)
-        np.save('data_output/risk_ensemble_v', risk_var)
-        np.save('data_output/resilience_field', resilience_field)
+    @profiled
+    def cfield(self, filename, real_n, time_index, plume_edge, max_conc):
+        self._render('_cfield_frames', filename=filename, real_n=real_n, time_index=time_index,
+                     plume_edge=plume_edge, max_conc=max_conc)
             
-    def riskfield(self, filename, real_n, time_index):
-        if not real_n == 'ensemble':
-            kfield = self.kfields[real_n]
-            alpha_v = 0.7
-            field_c = np.load(f'data_output/cfields/cfield_{real_n}.npy')
-            field_maxrisk = np.zeros(field_c.shape)
-            c0 = field_c[0].max()
-            field_maxrisk = np.where(field_c >= (self.mcl*c0), field_c/(self.mcl*c0), 0)
+    @profiled
+    def movie(self, filename, real_n, field='cfield', variance=False, plume_edge=False, max_conc=False,
+              time_index=None, fps=5, dpi=100):
+        # all the time steps (or time_index) of a cfield/riskfield map of a
+        # realization or of the ensemble (variance=True for its variance),
+        # encoded frame by frame into figures/{filename}.mp4, or .gif when
+        # ffmpeg is not available
+        if time_index is None:
+            time_index = range(self.nt)
+        from rendering import MapFigure
+        layers, frames = self._map_frames(field, real_n, time_index, variance)
+        with MapFigure(self, *layers) as figure:
+            markers = self._plume_markers(figure, real_n, plume_edge, max_conc)
+            with figure.record(filename, fps, dpi):
+                for i, data, vmin, vmax in frames:
+                    figure.update(data, vmin, vmax, i*self.dt)
+                    markers(i)
+                    figure.grab()
+        print(f'{len(time_index)} frames written to {figure.movie_file}')
+        return figure.movie_file
+
+    def _rrfield_chunk(self, k, chunks):
+        cfield_all = open_ensemble()
+        reliability_field = open_ensemble('data_output/reliability_field.npy', mode='r+')
+        resilience_field = open_ensemble('data_output/resilience_field.npy', mode='r+')
+        risk_stats = RiskAccumulator(self.mcl, self.dt)
+        for real_n in chunks[k]:
+            reliability_field[real_n], resilience_field[real_n] = risk_stats.update(cfield_all[real_n])
+        reliability_field.flush()
+        resilience_field.flush()
+        return risk_stats
+
+    @profiled
+    def rrfield_postprocessing(self):
+        field_shape = open_ensemble().shape[1:]
+        create_ensemble(self.n_realization, field_shape, 'data_output/reliability_field.npy').flush()
+        create_ensemble(self.n_realization, field_shape[1:], 'data_output/resilience_field.npy').flush()
+
+        risk_stats = RiskAccumulator(self.mcl, self.dt)
+        for stats in self._run_chunks(self._rrfield_chunk, 'rrfield'):
+            risk_stats.merge(stats)
+        np.save('data_output/risk_ensemble', risk_stats.risk.mean)
+        np.save('data_output/risk_ensemble_v', risk_stats.risk.var)
+        np.save('data_output/resilience_ensemble', risk_stats.resilience.mean)
+        np.save('data_output/resilience_ensemble_v', risk_stats.resilience.var)
+
+    def _risksweep_chunk(self, k, chunks, mcls):
+        cfield_all = open_ensemble()
+        sweep = ThresholdSweep(mcls, self.dt, (slice(self.target_yl, self.target_yu),
+                                               slice(self.target_xl, self.target_xu)))
+        for real_n in chunks[k]:
+            sweep.update(real_n, cfield_all[real_n])
+        return sweep
+
+    @profiled
+    def risksweep_postprocessing(self, mcls):
+        # risk, resilience and target-area maxima of several mcl in one pass over
+        # the ensemble, saved in data_output/sweep with the sorted mcls (the first
+        # axis of every output, after the realizations for maxrisk/maxresilience)
+        sweep = ThresholdSweep(mcls, self.dt)
+        for chunk_sweep in self._run_chunks(partial(self._risksweep_chunk, mcls=mcls), 'risksweep'):
+            sweep.merge(chunk_sweep)
+        os.makedirs('data_output/sweep', exist_ok=True)
+        risk = sweep.risk
+        np.save('data_output/sweep/mcl', sweep.thresholds)
+        np.save('data_output/sweep/risk_ensemble', risk)
+        np.save('data_output/sweep/risk_ensemble_v', risk*(1 - risk))
+        np.save('data_output/sweep/resilience_ensemble', sweep.resilience.mean)
+        np.save('data_output/sweep/resilience_ensemble_v', sweep.resilience.var)
+        np.save('data_output/sweep/maxrisk', np.array([sweep.maxrisk[real] for real in range(self.n_realization)]))
+        np.save('data_output/sweep/maxresilience',
+                np.array([sweep.maxresilience[real] for real in range(self.n_realization)]))
+        return sweep.thresholds
+
+    def _riskfield_frames(self, filename, real_n, time_index):
+        self._save_frames(filename, *self._map_frames('riskfield', real_n, time_index))
+        if real_n == 'ensemble':
+            self._save_frames(f'{filename}_v', *self._map_frames('riskfield', real_n, time_index, variance=True))
 
-            for i in time_index:
-                fig, ax = plt.subplots(figsize=(7,5))
-                cmap = copy(plt.get_cmap('Reds'))
-                def fmt(x, pos):
-                    a, b = '{:.0e}'.format(x).split('e')
-                    b = int(b)
-                    return r'${} \times 10^{{{}}}$'.format(a, b)
-
-                if not real_n == 'ensemble':
-                    img = ax.imshow(kfield, cmap='jet', extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0],
-                                    vmin=self.kmin, vmax=self.kmax)
-                img = ax.imshow(field_maxrisk[i], cmap=cmap, extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                                vmin=1, vmax=np.ceil(field_maxrisk[i][:,:-8].max()), alpha=alpha_v)
-                cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-                cbar.ax.tick_params(labelsize=14)
-                cbar.ax.set_ylabel(r'$\rm{max}$ $c~/~\rm{mcl}$', fontsize=25, fontname='Arial', labelpad=10)
-                cbar.solids.set_edgecolor("face")
-                ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                           color='k', marker='^' ,s=50)                  
-
-                ax.xaxis.set_major_locator(LinearLocator(5))
-                ax.xaxis.set_minor_locator(LinearLocator(21))
-                ax.yaxis.set_major_locator(LinearLocator(5))
-                ax.yaxis.set_minor_locator(LinearLocator(21))
-
-                rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                          (self.target_xu-self.target_xl)/self.lambda_x, 
-                                          (self.target_yu-self.target_yl)/self.lambda_y, 
-                                          fc='k', fill=None, linewidth=1.5)
-                plt.gca().add_patch(rectangle2)            
-
-                plt.xlim(0,self.Lx/self.lambda_x)
-                plt.ylim(0,self.Ly/self.lambda_y)
-                plt.xticks(fontsize=15, fontname='Arial')
-                plt.yticks(fontsize=15, fontname='Arial')
-                plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.text(5/self.lambda_x, 5/self.lambda_y, f'$t={i*self.dt}$', fontsize=15, color='k')
-                plt.tight_layout()
-                plt.savefig(f'figures/{filename}_{i}.png',dpi=200, bbox_inches='tight')            
-        else:
-            alpha_v = 1
-            field_maxrisk = np.load(f'data_output/risk_ensemble.npy')
-            risk_var = np.load('data_output/risk_ensemble_v.npy', )
-            
-            for i in time_index:
-                fig, ax = plt.subplots(figsize=(7,5))
-                cmap = copy(plt.get_cmap('Reds'))
-                def fmt(x, pos):
-                    a, b = '{:.0e}'.format(x).split('e')
-                    b = int(b)
-                    return r'${} \times 10^{{{}}}$'.format(a, b)
-
-                img = ax.imshow(field_maxrisk[i], cmap=cmap, extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                                vmin=0, vmax=1, alpha=alpha_v)
-                cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-                cbar.ax.tick_params(labelsize=14)
-                cbar.ax.set_ylabel(r'$\left<\Psi\right>$', fontsize=25, fontname='Arial', labelpad=10)
-                cbar.solids.set_edgecolor("face")
-                ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                           color='k', marker='^' ,s=50)            
-                
-
-                ax.xaxis.set_major_locator(LinearLocator(5))
-                ax.xaxis.set_minor_locator(LinearLocator(21))
-                ax.yaxis.set_major_locator(LinearLocator(5))
-                ax.yaxis.set_minor_locator(LinearLocator(21))
-
-                rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                          (self.target_xu-self.target_xl)/self.lambda_x, 
-                                          (self.target_yu-self.target_yl)/self.lambda_y, 
-                                          fc='k', fill=None, linewidth=1.5)
-                plt.gca().add_patch(rectangle2)            
-
-                plt.xlim(0,self.Lx/self.lambda_x)
-                plt.ylim(0,self.Ly/self.lambda_y)
-                plt.xticks(fontsize=15, fontname='Arial')
-                plt.yticks(fontsize=15, fontname='Arial')
-                plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.text(5/self.lambda_x, 5/self.lambda_y, f'$t={i*self.dt}$', fontsize=15, color='k')
-                plt.tight_layout()
-                plt.savefig(f'figures/{filename}_{i}.png',dpi=200, bbox_inches='tight')
-                
-                fig, ax = plt.subplots(figsize=(7,5))
-                cmap = copy(plt.get_cmap('Purples'))
-                def fmt(x, pos):
-                    a, b = '{:.0e}'.format(x).split('e')
-                    b = int(b)
-                    return r'${} \times 10^{{{}}}$'.format(a, b)
-
-                img = ax.imshow(risk_var[i], cmap=cmap, extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                                vmin=0, vmax=np.max(risk_var[i][:,:-self.lambda_x]), alpha=alpha_v)
-                   
-                cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-                cbar.ax.tick_params(labelsize=14)
-                cbar.ax.set_ylabel(r'$\sigma^2_{\Psi}$', fontsize=25, fontname='Arial', labelpad=10)
-                cbar.solids.set_edgecolor("face")
-                ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                           color='k', marker='^' ,s=50)            
-
-                ax.xaxis.set_major_locator(LinearLocator(5))
-                ax.xaxis.set_minor_locator(LinearLocator(21))
-                ax.yaxis.set_major_locator(LinearLocator(5))
-                ax.yaxis.set_minor_locator(LinearLocator(21))
-
-                rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                          (self.target_xu-self.target_xl)/self.lambda_x, 
-                                          (self.target_yu-self.target_yl)/self.lambda_y, 
-                                          fc='k', fill=None, linewidth=1.5)
-                plt.gca().add_patch(rectangle2)            
-
-                plt.xlim(0,self.Lx/self.lambda_x)
-                plt.ylim(0,self.Ly/self.lambda_y)
-                plt.xticks(fontsize=15, fontname='Arial')
-                plt.yticks(fontsize=15, fontname='Arial')
-                plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-                plt.text(5/self.lambda_x, 5/self.lambda_y, f'$t={i*self.dt}$', fontsize=15, color='k')
-                plt.tight_layout()
-                plt.savefig(f'figures/{filename}_v_{i}.png',dpi=200, bbox_inches='tight')
+    @profiled
+    def riskfield(self, filename, real_n, time_index):
+        self._render('_riskfield_frames', filename=filename, real_n=real_n, time_index=time_index)
 
-        
-    def resiliencefield(self, filename, real_n):        
+    def _resiliencefield_frames(self, filename, real_n):
+        from rendering import MapFigure
         if not real_n == 'ensemble':
-            kfield = self.kfields[real_n]
-            field_resilience = np.load(f'data_output/resilience_field.npy')[real_n]
-            alpha_v = 0.7
+            background = self.kfields[real_n]
+            field_resilience = np.load(f'data_output/resilience_field.npy', mmap_mode='r')[real_n]
         else:
-            field_resilience = np.load(f'data_output/resilience_field.npy').mean(axis=0)
-            field_resilience_var = np.load(f'data_output/resilience_field.npy').var(axis=0)
-            alpha_v = 1
+            background = None
+            field_resilience = np.load(f'data_output/resilience_ensemble.npy')
+            field_resilience_var = np.load(f'data_output/resilience_ensemble_v.npy')
         
-        fig, ax = plt.subplots(figsize=(7,5))
-        cmap = copy(plt.get_cmap('Blues'))
-        def fmt(x, pos):
-            a, b = '{:.0e}'.format(x).split('e')
-            b = int(b)
-            return r'${} \times 10^{{{}}}$'.format(a, b)
-
-        if not real_n == 'ensemble':
-            img = ax.imshow(kfield, cmap='jet', extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                            vmin=self.kmin, vmax=self.kmax)
-        img = ax.imshow(field_resilience, cmap=cmap, extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                        vmin=0, vmax=np.ceil(field_resilience[:,:-8].max()), alpha=0.7)
-        cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-        cbar.ax.tick_params(labelsize=14)
-        cbar.ax.set_ylabel(r'$\left<R_L\right>$', fontsize=25, fontname='Arial', labelpad=10)
-        cbar.solids.set_edgecolor("face")
-        ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                   color='k', marker='^' ,s=50)          
-        
-        ax.xaxis.set_major_locator(LinearLocator(5))
-        ax.xaxis.set_minor_locator(LinearLocator(21))
-        ax.yaxis.set_major_locator(LinearLocator(5))
-        ax.yaxis.set_minor_locator(LinearLocator(21))
-        
-        rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                  (self.target_xu-self.target_xl)/self.lambda_x, 
-                                  (self.target_yu-self.target_yl)/self.lambda_y, 
-                                  fc='k', fill=None, linewidth=1.5)
-        plt.gca().add_patch(rectangle2)        
-        
-        plt.xlim(0,self.Lx/self.lambda_x)
-        plt.ylim(0,self.Ly/self.lambda_y)
-        plt.xticks(fontsize=15, fontname='Arial')
-        plt.yticks(fontsize=15, fontname='Arial')
-        plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-        plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
-
-        plt.tight_layout()
-        plt.savefig(f'figures/{filename}.png',dpi=200, bbox_inches='tight')
+        with MapFigure(self, 'Blues', r'$\left<R_L\right>$', 0.7, background, time_label=False) as figure:
+            figure.update(field_resilience, 0, np.ceil(field_resilience[:,:-8].max()))
+            figure.save(filename)
         
         if real_n == 'ensemble':
-            fig, ax = plt.subplots(figsize=(7,5))
-            cmap = copy(plt.get_cmap('Purples'))
-            def fmt(x, pos):
-                a, b = '{:.0e}'.format(x).split('e')
-                b = int(b)
-                return r'${} \times 10^{{{}}}$'.format(a, b)
-
-            img = ax.imshow(field_resilience_var, cmap=cmap, extent=[0,self.Lx/self.lambda_x,self.Ly/self.lambda_y,0], 
-                            vmin=0, vmax=np.ceil(field_resilience_var[:,:-8].max()), alpha=0.7)
-            cbar = ax.figure.colorbar(img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
-            cbar.ax.tick_params(labelsize=14)
-            cbar.ax.set_ylabel(r'$\sigma^2_{R_L}$', fontsize=25, fontname='Arial', labelpad=10)
-            cbar.solids.set_edgecolor("face")
-            ax.scatter(self.observation_wells.T[0]/self.lambda_x, self.observation_wells.T[1]/self.lambda_y, 
-                       color='k', marker='^' ,s=50)          
-
-            ax.xaxis.set_major_locator(LinearLocator(5))
-            ax.xaxis.set_minor_locator(LinearLocator(21))
-            ax.yaxis.set_major_locator(LinearLocator(5))
-            ax.yaxis.set_minor_locator(LinearLocator(21))
-
-            rectangle2 = plt.Rectangle((self.target_xl/self.lambda_x,self.target_yl/self.lambda_y), 
-                                      (self.target_xu-self.target_xl)/self.lambda_x, 
-                                      (self.target_yu-self.target_yl)/self.lambda_y, 
-                                      fc='k', fill=None, linewidth=1.5)
-            plt.gca().add_patch(rectangle2)        
-
-            plt.xlim(0,self.Lx/self.lambda_x)
-            plt.ylim(0,self.Ly/self.lambda_y)
-            plt.xticks(fontsize=15, fontname='Arial')
-            plt.yticks(fontsize=15, fontname='Arial')
-            plt.xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
-            plt.ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
+            with MapFigure(self, 'Purples', r'$\sigma^2_{R_L}$', 0.7, time_label=False) as figure:
+                figure.update(field_resilience_var, 0, np.ceil(field_resilience_var[:,:-8].max()))
+                figure.save(f'{filename}_v')
 
-            plt.tight_layout()
-            plt.savefig(f'figures/{filename}.png',dpi=200, bbox_inches='tight')
+    @profiled
+    def resiliencefield(self, filename, real_n):
+        self._render('_resiliencefield_frames', filename=filename, real_n=real_n)
             
 
+    @profiled
     def eta_postprocessing(self):
-        cell_number = self.Lx*self.Ly
-        sflow = np.zeros((self.n_realization,self.Ly,self.Lx))
-
-        for i in range(self.n_realization):
-            velocities = []
-            f = open(f'tmp/model-{i}.ftl', 'r')
-            for line in f:
-                if line[3] == 'X':
-                    line = f.readline()
-                    velocities.append(np.asarray(line.split(), dtype=float))
-            f.close()
-            sflow[i] = np.asarray(velocities).reshape((self.Ly,self.Lx))
+        sflow = load_flux_ensemble(self.n_realization, (self.Ly,self.Lx), 'X', self.n_workers, self.chunksize,
+                                   profiler=self.profiler)
         
         np.save('data_output/sflow.npy',sflow)
         
@@ -541,29 +506,50 @@ class plotinfo:
         
         np.save('data_output/eta', eta)
         
+    @profiled
+    def breakthrough_postprocessing(self, levels=(0.05, 0.5, 0.95), quantiles=(0.05, 0.5, 0.95)):
+        # arrival times and peak mass flux at the control planes of config.yaml,
+        # from the PAR2 result files only (see breakthrough.py)
+        time, curves, items = load_results(range(self.n_realization), n_workers=self.n_workers,
+                                           chunksize=self.chunksize, profiler=self.profiler)
+        statistics = breakthrough_statistics(time, curves, levels, quantiles)
+        np.savez('data_output/breakthrough', time=time, items=np.asarray(items), **statistics)
+
+        median = list(quantiles).index(0.5) if 0.5 in quantiles else None
+        for i, item in enumerate(items):
+            for j, level in enumerate(levels):
+                arrival = (f', median arrival time {statistics["arrival_quantiles"][median,i,j]:.4g}'
+                           if median is not None else '')
+                print(f'{item}: {statistics["reached"][i,j]:.0%} of the realizations reach {level:g}{arrival}')
+        return statistics
+
+    @profiled
     def maxriskresilience_postprocessing(self):
-        cfield_all = np.load('data_output/cfields/cfield_all.npy')
-        resilience_field = np.load('data_output/resilience_field.npy')
+        cfield_all = open_ensemble()
+        resilience_field = np.load('data_output/resilience_field.npy', mmap_mode='r')
         maxrisk = np.zeros(self.n_realization)
         maxresilience = np.zeros(self.n_realization)
         
         for real_n in range(self.n_realization):
-            field_c = cfield_all[real_n]
-            field_maxrisk = np.zeros(field_c.shape)    
-            field_reliability = np.zeros(field_c.shape)
-            nt = len(field_c)
-            c0 = field_c[0].max()
-            
+            c0 = cfield_all[real_n,0].max()
+            # only the target area is read from the ensemble store
+            field_c = cfield_all[real_n,:,self.target_yl:self.target_yu,self.target_xl:self.target_xu]
             field_maxrisk = np.where(field_c >= (self.mcl*c0), field_c/(self.mcl*c0), 0)
-            field_resilience = resilience_field[real_n]
+            field_resilience = resilience_field[real_n,self.target_yl:self.target_yu,self.target_xl:self.target_xu]
 
-            maxrisk[real_n] = field_maxrisk[:,self.target_yl:self.target_yu,self.target_xl:self.target_xu].max()
-            maxresilience[real_n] = field_resilience[self.target_yl:self.target_yu,self.target_xl:self.target_xu].max()
+            maxrisk[real_n] = field_maxrisk.max()
+            maxresilience[real_n] = field_resilience.max()
         
         np.save('data_output/maxrisk', maxrisk)
         np.save('data_output/maxresilience', maxresilience)
         
+    @profiled
     def eta_rr(self, filename, real_n):
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import LinearLocator
+        from scipy.special import erf
+        from rendering import figure_file
+
         eta = np.load('data_output/eta.npy')
         maxrisk = np.load('data_output/maxrisk.npy')
         maxresilience = np.load('data_output/maxresilience.npy')
@@ -571,7 +557,7 @@ class plotinfo:
         fig, ax = plt.subplots(figsize=(6,5))
 
         interp = np.linspace(0,np.ceil(eta.max()),100)
-        plt.plot(interp, 293.798518*scipy.special.erf(2.375823*interp) + 449.030143, color='b', linewidth=2, label='Trend line')
+        plt.plot(interp, 293.798518*erf(2.375823*interp) + 449.030143, color='b', linewidth=2, label='Trend line')
         plt.scatter(eta, maxrisk, color='gray', s=25, alpha=0.8)
 
         if not real_n == 'ensemble':
@@ -591,7 +577,7 @@ class plotinfo:
 
         plt.legend(fontsize=12)
         plt.tight_layout()
-        plt.savefig(f'figures/{filename}.png',dpi=200, bbox_inches='tight')
+        plt.savefig(figure_file(filename),dpi=200, bbox_inches='tight')
         plt.show()
         
         fig, ax = plt.subplots(figsize=(6,5))
@@ -616,44 +602,61 @@ class plotinfo:
 
         plt.legend(fontsize=12)
         plt.tight_layout()
-        plt.savefig(f'figures/{filename}.png',dpi=200, bbox_inches='tight')
+        plt.savefig(figure_file(filename),dpi=200, bbox_inches='tight')
         plt.show()
     
+    @profiled
     def well_postprocessing(self):
-        cfield_all = np.load('data_output/cfields/cfield_all.npy')
-        obwells_conc = []
-        for i in range(len(self.observation_wells)):
-            obwells_conc.append(cfield_all[:,:,self.observation_wells.T[1][i],self.observation_wells.T[0][i]])
-        obwells_conc = np.asarray(obwells_conc)
-        obwells_maxconc = obwells_conc.max(axis=2)
+        if os.path.exists(INDEX_FILE) and CellIndex().complete:
+            # only the blocks of the wells are read from the cell index
+            obwells_maxconc = CellIndex().peak(self.observation_wells)
+        else:
+            cfield_all = open_ensemble()
+            # (realization, time, well) series gathered straight from the memory map
+            obwells_conc = cfield_all[:,:,self.observation_wells.T[1],self.observation_wells.T[0]]
+            obwells_maxconc = obwells_conc.max(axis=1).T
         np.save('data_output/obwells_maxconc', obwells_maxconc)
     
-    def cdf_maxconc(self, filename):
-        obwells_maxconc = np.load('data_output/obwells_maxconc.npy' )
-        
-        for i in range(len(obwells_maxconc)):
+    @profiled
+    def cdf_maxconc(self, filename, n_boot=1000, confidence=0.95):
+        # exact survival functions of the maximum concentration at all wells with
+        # bootstrap confidence bands, see exceedance.py
+        import matplotlib.pyplot as plt
+        from rendering import figure_file
+
+        obwells_maxconc = np.load('data_output/obwells_maxconc.npy')
+        exceedance = Exceedance(obwells_maxconc)
+        n_wells = len(obwells_maxconc)
+
+        p_mcl = exceedance.probability([self.mcl])[:,0]
+        lower_mcl, upper_mcl = exceedance.bootstrap([self.mcl], n_boot, confidence)
+        for i in range(n_wells):
+            print(f'the probability of the maximum concentration at the well {i+1} over {self.mcl} is '
+                  f'{round(p_mcl[i],3)} ({confidence:.0%} confidence interval {round(lower_mcl[i,0],3)}-{round(upper_mcl[i,0],3)})')
+
+        positive = obwells_maxconc[obwells_maxconc > 0]
+        if positive.size == 0:
+            print('no concentration reached the observation wells, nothing to plot')
+            return p_mcl
+        grid = np.unique(np.concatenate((np.geomspace(positive.min(), positive.max(), 200), [self.mcl])))
+        lower, upper = exceedance.bootstrap(grid, n_boot, confidence)
+
+        # one figure per well, {filename}_{i}.png, with the bands of all the
+        # wells computed at once above
+        for i in range(n_wells):
+            conc, survival_p = exceedance.survival(i)
+            inside = conc > 0
+            if not inside.any():
+                print(f'no concentration reached the well {i+1}, no figure')
+                continue
             fig, ax = plt.subplots(figsize=(6,5))
-            obdata = obwells_maxconc[i][obwells_maxconc[i]!=0]
-
-            numerator = len(obwells_maxconc[i][obwells_maxconc[i]==0])
-            denominator = len(obwells_maxconc[i])
-            bottom_p = numerator/denominator
-
-            hist_result, interval = np.histogram(obdata, density=True, bins=100)
-            dx = interval[1] - interval[0]
-            cdf_result = np.cumsum(hist_result)*dx
-            cdf = (cdf_result*(1-bottom_p)) + bottom_p
-            survival_p = 1 - cdf
-            midpoint = (interval[:-1]+interval[1:])/2
-            plt.plot(midpoint,survival_p, label=f'well {i+1}', linewidth=2,)
-        
-            plt.xscale('log')
-            mcl_index = np.argmin(np.abs(midpoint-self.mcl))
-
-            print(f'the probability of the maximum concentration at the well {i+1} over {round(midpoint[mcl_index],3)} is {round(survival_p[mcl_index],3)}')
-
-            plt.ylim(0, np.max([survival_p]))
+            line, = plt.step(np.r_[conc[inside][0], conc[inside]], np.r_[inside.mean(), survival_p[inside]],
+                             where='post', label=f'well {i+1}', linewidth=2)
+            plt.fill_between(grid, lower[i], upper[i], step='post', color=line.get_color(), alpha=0.2, linewidth=0)
+            plt.axvline(self.mcl, color='k', linestyle='--', linewidth=1)
 
+            plt.xscale('log')
+            plt.ylim(0, max(upper[i].max(), 1e-3))
             plt.xticks(fontsize=15, fontname='Arial')
             plt.yticks(fontsize=15, fontname='Arial')
             plt.xlabel(r'$c_{max}$', fontsize=25, fontname='Arial', labelpad=5)
@@ -661,5 +664,6 @@ class plotinfo:
             plt.tick_params(which="major", direction="in", right=True, top=True, length=5, pad=7)
             plt.tick_params(which="minor", direction="in", right=True, top=True, length=3)
             plt.legend(fontsize=12, loc=3)
-            plt.savefig(f'figures/{filename}_{i}.png',dpi=200, bbox_inches='tight')
+            plt.savefig(figure_file(f'{filename}_{i}'),dpi=200, bbox_inches='tight')
             plt.show()
+        return p_mcl
@@ -0,0 +1,131 @@
+import numpy as np
+
+# Single-pass ensemble statistics.
+#
+# RunningStats keeps the running mean and the sum of squared deviations of a
+# stream of equally shaped arrays (Welford's method), so ensemble maps are
+# available after one pass with the memory of a single field. Two partial
+# accumulators, e.g. from different worker processes, are combined with
+# merge() (Chan et al. pairwise update).
+
+
+class RunningStats:
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x - self.mean)
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta*(other.n/n)
+        self.m2 += other.m2 + delta**2*(self.n*other.n/n)
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        # population variance, as np.var(axis=0) over the realizations
+        return self.m2/self.n
+
+
+class RiskAccumulator:
+    # exceedance probability of mcl*c0 and resilience loss (time above
+    # mcl*c0) of a stream of concentration fields of shape (nt, Ly, Lx)
+    def __init__(self, mcl, dt):
+        self.mcl = mcl
+        self.dt = dt
+        self.risk = RunningStats()
+        self.resilience = RunningStats()
+
+    def update(self, field_c):
+        c0 = field_c[0].max()
+        field_reliability = field_c >= (self.mcl*c0)
+        field_resilience = np.sum(field_reliability, axis=0)*self.dt
+        self.risk.update(field_reliability)
+        self.resilience.update(field_resilience)
+        return field_reliability, field_resilience
+
+    def merge(self, other):
+        self.risk.merge(other.risk)
+        self.resilience.merge(other.resilience)
+        return self
+
+
+class ThresholdSweep:
+    # RiskAccumulator for several thresholds (ratios to c0) at once. Every cell
+    # of a realization is given its level, the number of thresholds*c0 it
+    # reaches (one searchsorted over the sorted thresholds), and the ensemble
+    # keeps how many realizations sit at each level in every cell; the
+    # realizations exceeding threshold k are those above level k, a reverse
+    # cumulative sum over the levels. The time above each threshold comes from
+    # the same levels with one bincount per realization. In the target area
+    # only the largest concentration is needed: its ratio to threshold*c0 is
+    # the maxrisk of every threshold it exceeds.
+    def __init__(self, thresholds, dt, target=(slice(None), slice(None))):
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+        self.dt = dt
+        self.target = target
+        self.n = 0
+        self.levels = None
+        self.resilience = RunningStats()
+        self.maxrisk = {}
+        self.maxresilience = {}
+
+    def update(self, real, field_c):
+        field_c = np.asarray(field_c)
+        c0 = field_c[0].max()
+        k = len(self.thresholds)
+        level = np.searchsorted(self.thresholds*c0, field_c, side='right')
+        if self.levels is None:
+            self.levels = np.zeros((k + 1,) + field_c.shape, dtype=np.uint32)
+        # every (level, cell) pair appears once, so the fancy-indexed increment is exact
+        cells = np.arange(level.size)
+        self.levels.reshape((k + 1, -1))[level.ravel(), cells] += 1
+        self.n += 1
+
+        # time steps at each level, then above each threshold
+        ny_nx = level[0].size
+        steps = np.bincount((level.reshape((len(level), -1))*ny_nx + cells[:ny_nx]).ravel(),
+                            minlength=(k + 1)*ny_nx).reshape((k + 1,) + level.shape[1:])
+        field_resilience = np.cumsum(steps[::-1], axis=0)[::-1][1:]*self.dt
+        self.resilience.update(field_resilience)
+
+        peak = field_c[(slice(None),) + tuple(self.target)].max()
+        self.maxrisk[real] = np.where(peak >= self.thresholds*c0, peak/(self.thresholds*c0), 0)
+        self.maxresilience[real] = field_resilience[(slice(None),) + tuple(self.target)].max(axis=(1, 2))
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.levels is None:
+            self.levels = other.levels.copy()
+        else:
+            self.levels += other.levels
+        self.n += other.n
+        self.resilience.merge(other.resilience)
+        self.maxrisk.update(other.maxrisk)
+        self.maxresilience.update(other.maxresilience)
+        return self
+
+    @property
+    def risk(self):
+        # exceedance probability of every threshold, (k, nt, Ly, Lx)
+        return np.cumsum(self.levels[::-1], axis=0)[::-1][1:]/self.n
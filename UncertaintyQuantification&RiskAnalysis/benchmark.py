@@ -0,0 +1,229 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from instrumentation import children_cpu, maxrss_mb
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Benchmarks of the RAUQ post-processing stages and plots on synthetic data.
+#
+# A working directory is filled with PAR2-style particle snapshots
+# (output/snap-{real}-{step}.csv), MODFLOW-style link files (tmp/model-{real}.ftl)
+# and a K-field stack (Kfileds_Hydrogen.npy) of the requested size, then every
+# stage runs in a fresh process so that its peak memory is its own. No external
+# executables are needed. The results are written as JSON and can be compared
+# with the ones of another commit:
+#
+#   python benchmark.py --realizations 20 --particles 10000 --output new.json --compare old.json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = {
+    'cfield': lambda info: info.cfield_postprocessing(resume=False),
+    'referencepoints': lambda info: info.referencepoints_postprocessing(),
+    'cfield_ensemble': lambda info: info.cfield_ensemble_postprocessing(),
+    'rrfield': lambda info: info.rrfield_postprocessing(),
+    'eta': lambda info: info.eta_postprocessing(),
+    'maxriskresilience': lambda info: info.maxriskresilience_postprocessing(),
+    'cellindex': lambda info: info.cellindex_postprocessing(resume=False),
+    'well': lambda info: info.well_postprocessing(),
+    'plot_cfield': lambda info: info.cfield('bench_cfield', 0, [0, info.nt//2, info.nt-1], True, True),
+    'plot_riskfield': lambda info: info.riskfield('bench_riskfield', 'ensemble', [0, info.nt//2, info.nt-1]),
+    'plot_resiliencefield': lambda info: info.resiliencefield('bench_resilience', 'ensemble'),
+    'plot_eta_rr': lambda info: info.eta_rr('bench_eta_rr', 'ensemble'),
+    'movie': lambda info: info.movie('bench_movie', 'ensemble', 'riskfield'),
+}
+
+# post-processing stages whose outputs the plots read
+PLOT_INPUTS = {'plot_cfield': ('referencepoints',), 'plot_riskfield': ('rrfield',),
+               'plot_resiliencefield': ('rrfield',), 'plot_eta_rr': ('eta', 'maxriskresilience'),
+               'movie': ('rrfield',)}
+
+
+def plotinfo_arguments(config):
+    nx, ny = config['nx'], config['ny']
+    source = (int(0.15*nx), int(0.22*nx), int(0.43*ny), int(0.57*ny))
+    target = (int(0.69*nx), int(0.76*nx), int(0.37*ny), int(0.63*ny))
+    wells = [(target[0], target[2]), (target[0], (target[2] + target[3])//2), (target[0], target[3])]
+    return ((config['realizations'], np.exp(1.60943), nx, ny, 1, 1, 8, 8) + source + target +
+            (0.001, wells, np.arange(config['nt'])*1000, 4))
+
+
+def generate(config):
+    # synthetic inputs in the current directory: a plume released in the source
+    # box drifting towards the target box and spreading with time
+    nx, ny, nt, n = config['nx'], config['ny'], config['nt'], config['particles']
+    arguments = plotinfo_arguments(config)
+    source_xl, source_xu, source_yl, source_yu = arguments[8:12]
+    tstep = arguments[18]
+    rng = np.random.default_rng(config['seed'])
+
+    for path in ('output', 'tmp', 'figures', 'data_output/cfields', 'data_output/referencepoints'):
+        os.makedirs(path, exist_ok=True)
+    np.save('Kfileds_Hydrogen.npy', rng.normal(1.6, 1.3, (config['realizations'], ny, nx)))
+    ids = np.arange(n)
+    for real in range(config['realizations']):
+        x0 = rng.uniform(source_xl, source_xu, n)
+        y0 = rng.uniform(source_yl, source_yu, n)
+        for k, step in enumerate(tstep):
+            x = x0 + 0.8*nx*k/nt + rng.normal(0, 1 + k, n)
+            y = y0 + rng.normal(0, 1 + 0.5*k, n)
+            np.savetxt(f'output/snap-{real}-{step}.csv', np.column_stack((ids, x, y, np.full(n, 0.5))),
+                       fmt=('%d', '%.6f', '%.6f', '%.1f'), delimiter=',', header='id,x coord,y coord,z coord',
+                       comments='')
+        with open(f'tmp/model-{real}.ftl', 'w') as f:
+            for label in ('QXX', 'QYY'):
+                f.write(f" '{label:<16}'  1  {ny}  {nx}  1\n")
+                np.savetxt(f, rng.uniform(0.001, 0.02, nx*ny)[None, :], fmt='%.8E')
+
+
+def _run_stage(config, stage, queue):
+    os.chdir(config['workdir'])
+    sys.path.insert(0, HERE)
+    import matplotlib
+    matplotlib.use('Agg')
+    import RAUQ_function as plib
+
+    info = plib.plotinfo(*plotinfo_arguments(config), n_workers=config['workers'], storage=config['storage'])
+    rss_before = maxrss_mb(resource.RUSAGE_SELF) if resource else None
+    tracemalloc.start()
+    cpu, children, wall = time.process_time(), children_cpu(), time.perf_counter()
+    STAGES[stage](info)
+    wall = time.perf_counter() - wall
+    cpu, children = time.process_time() - cpu, children_cpu() - children
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    queue.put({'wall_s': wall, 'cpu_s': cpu, 'children_cpu_s': children,
+               'rss_before_mb': rss_before,
+               'peak_rss_mb': maxrss_mb(resource.RUSAGE_SELF) if resource else None,
+               'peak_children_rss_mb': maxrss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+               'peak_traced_mb': traced_peak/1024**2})
+
+
+def run_stage(config, stage):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage, args=(config, stage, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'stage {stage} failed (exit code {process.exitcode})')
+    return queue.get()
+
+
+def startup_time(repeat=5):
+    # import time of RAUQ_function in a fresh interpreter, best of repeat runs
+    code = ('import sys, time; t = time.perf_counter(); import RAUQ_function; '
+            'print(time.perf_counter() - t, *[m for m in ("matplotlib", "scipy", "pandas") if m in sys.modules])')
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True,
+                             check=True).stdout.split()
+        if best is None or float(out[0]) < best['import_s']:
+            best = {'import_s': float(out[0]), 'heavy_modules': out[1:]}
+    return best
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_order(stages):
+    # the selected stages and the post-processing stages they depend on, in
+    # run order: an upstream stage may itself need one of the selected ones
+    # (cfield_ensemble needs cfield), so they cannot all run first
+    sys.path.insert(0, HERE)
+    from stages import StageRunner
+    needed = [upstream for stage in stages for upstream in PLOT_INPUTS.get(stage, (stage,))]
+    order = StageRunner(None).selected(needed)
+    return order + [stage for stage in stages if stage not in order]
+
+
+def benchmark(config, stages):
+    results = {'commit': _git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+               'cpu_count': os.cpu_count(), 'config': config, 'startup': startup_time(), 'stages': {}}
+    print(f'{"import RAUQ_function":<22}{results["startup"]["import_s"]:>10.3f} s'
+          + (f'  (loads {", ".join(results["startup"]["heavy_modules"])})' if results['startup']['heavy_modules'] else ''))
+    for stage in run_order(stages):
+        if stage not in stages:
+            print(f'{stage:<22}(not timed, needed by the selected stages)')
+            run_stage(config, stage)
+            continue
+        runs = [run_stage(config, stage) for _ in range(config['repeat'])]
+        best = min(runs, key=lambda run: run['wall_s'])
+        results['stages'][stage] = dict(best, wall_all_s=[run['wall_s'] for run in runs])
+        print(f'{stage:<22}{best["wall_s"]:>10.3f} s{best["peak_traced_mb"]:>10.1f} MB traced'
+              + (f'{best["peak_rss_mb"]:>10.1f} MB rss' if best['peak_rss_mb'] is not None else ''))
+    return results
+
+
+def compare(results, baseline):
+    print(f'\n{"stage":<22}{"baseline":>10}{"current":>10}{"speedup":>10}')
+    if 'startup' in baseline:
+        old, new = baseline['startup']['import_s'], results['startup']['import_s']
+        print(f'{"import RAUQ_function":<22}{old:>10.3f}{new:>10.3f}{old/new:>9.2f}x')
+    for stage, result in results['stages'].items():
+        if stage in baseline['stages']:
+            old = baseline['stages'][stage]['wall_s']
+            print(f'{stage:<22}{old:>10.3f}{result["wall_s"]:>10.3f}{old/result["wall_s"]:>9.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RAUQ post-processing stages on synthetic data.')
+    parser.add_argument('--realizations', type=int, default=8)
+    parser.add_argument('--particles', type=int, default=2000)
+    parser.add_argument('--nx', type=int, default=170)
+    parser.add_argument('--ny', type=int, default=150)
+    parser.add_argument('--nt', type=int, default=11)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--storage', default='dense')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--workdir', help='directory for the synthetic data (default: a temporary one)')
+    parser.add_argument('--keep-data', action='store_true', help='reuse the data already in --workdir')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in
+              ('realizations', 'particles', 'nx', 'ny', 'nt', 'workers', 'storage', 'repeat', 'seed')}
+    output = os.path.abspath(args.output)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config['workdir'] = os.path.abspath(args.workdir or tmpdir)
+        os.makedirs(config['workdir'], exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(config['workdir'])
+        if not args.keep_data:
+            t = time.perf_counter()
+            generate(config)
+            print(f'synthetic data generated in {time.perf_counter() - t:.1f} s')
+        os.chdir(cwd)
+        results = benchmark(config, args.stages)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'results written to {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
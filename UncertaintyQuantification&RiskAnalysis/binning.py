@@ -0,0 +1,41 @@
+import numpy as np
+
+# Particle binning engine: counts particles per grid cell with a single
+# np.bincount call instead of one Python increment per particle.
+#
+# Cells follow the convention of the original cfield_postprocessing loop,
+# i.e. a particle at (x, y) falls in cell (floor(y/block_y)-1, floor(x/block_x)-1).
+# Particles whose cell lies outside the grid are not wrapped around through
+# negative indices but counted separately and reported to the caller.
+
+
+def grid_shape(Lx, Ly, block_x=1, block_y=1):
+    return int(round(Ly/block_y)), int(round(Lx/block_x))
+
+
+def cell_indices(x, y, Lx, Ly, block_x=1, block_y=1):
+    ny, nx = grid_shape(Lx, Ly, block_x, block_y)
+    ix = np.floor(np.asarray(x)/block_x).astype(np.intp) - 1
+    iy = np.floor(np.asarray(y)/block_y).astype(np.intp) - 1
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    return iy*nx + ix, inside
+
+
+def bin_particles(x, y, Lx, Ly, block_x=1, block_y=1):
+    ny, nx = grid_shape(Lx, Ly, block_x, block_y)
+    flat, inside = cell_indices(x, y, Lx, Ly, block_x, block_y)
+    counts = np.bincount(flat[inside], minlength=ny*nx).reshape((ny, nx))
+    return counts, np.count_nonzero(~inside)
+
+
+def bin_snapshots(coordinates, Lx, Ly, block_x=1, block_y=1):
+    # coordinates: (nt, 2, particle_n) array holding x and y of every snapshot.
+    # All snapshots are binned at once by offsetting the flat cell index of
+    # snapshot i by i*ny*nx, so the whole realization costs one bincount.
+    coordinates = np.asarray(coordinates)
+    nt = coordinates.shape[0]
+    ny, nx = grid_shape(Lx, Ly, block_x, block_y)
+    flat, inside = cell_indices(coordinates[:, 0], coordinates[:, 1], Lx, Ly, block_x, block_y)
+    flat += np.arange(nt, dtype=np.intp)[:, None]*(ny*nx)
+    counts = np.bincount(flat[inside], minlength=nt*ny*nx).reshape((nt, ny, nx))
+    return counts, np.count_nonzero(~inside, axis=1)
@@ -0,0 +1,126 @@
+import os
+import warnings
+from functools import partial
+import numpy as np
+
+from parallel import run_realizations
+
+# Breakthrough curves written by PAR2 (output/result-{real}.csv).
+#
+# Every result file has a header with the labels of the items of config.yaml
+# (e.g. 'cbtx x=117.0', the fraction of particles past the plane x=117) after
+# the time column, and one row per output step. The files of all realizations
+# are parsed in parallel into one (n_realization, n_steps, n_items) array, nan
+# padded when a run wrote fewer steps, and cached in output/results.npz with
+# the size and modification time of every file, so they are only parsed again
+# when a file changed.
+#
+# From the cumulative curves F(t) the indicators below are computed for all
+# realizations and items at once:
+#
+# arrival_times  first time F reaches each level (e.g. 5%, 50%, 95% of the mass)
+# peak_flux      maximum of dF/dt, the peak of the mass flux through the plane,
+#                and its time
+#
+# They do not need the particle snapshots nor the concentration fields.
+
+RESULT_FILE = 'output/result-{}.csv'
+CACHE_FILE = 'output/results.npz'
+
+
+def read_result(path):
+    # labels of the columns and (n_steps, n_columns) values of a result file
+    with open(path, 'rb') as f:
+        labels = [label.strip() for label in f.readline().decode().split(',')]
+        # all values parsed in bulk, as in ftl_reader
+        values = np.fromstring(f.read().replace(b',', b' '), sep=' ')
+    return labels, values.reshape((-1, len(labels)))
+
+
+def read_realization(real, result_file=RESULT_FILE):
+    return read_result(result_file.format(real))
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _split(labels, values):
+    # the time column (the row number when there is none) and the items
+    if labels and labels[0].lower().startswith('time'):
+        return values[:, 0], labels[1:], values[:, 1:]
+    return np.arange(len(values), dtype=np.float64), labels, values
+
+
+def load_results(realizations, result_file=RESULT_FILE, n_workers=1, chunksize=None, cache_file=CACHE_FILE,
+                 profiler=None):
+    # time (n_steps,), curves (n_realization, n_steps, n_items) and item labels
+    realizations = list(realizations)
+    paths = [result_file.format(real) for real in realizations]
+    signatures = np.array([_signature(path) for path in paths], dtype=np.int64)
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['realizations'], realizations) and \
+                    np.array_equal(cache['signatures'], signatures):
+                return cache['time'], cache['curves'], cache['items'].tolist()
+
+    results = run_realizations(partial(read_realization, result_file=result_file), realizations, n_workers,
+                               chunksize, 'results', profiler=profiler)
+    n_steps = max(len(values) for labels, values in results.values())
+    time, items = None, None
+    curves = None
+    for k, real in enumerate(realizations):
+        real_time, real_items, values = _split(*results[real])
+        if curves is None:
+            items = real_items
+            curves = np.full((len(realizations), n_steps, len(items)), np.nan)
+        elif real_items != items:
+            raise ValueError(f'{paths[k]} has the items {real_items}, expected {items}')
+        curves[k, :len(values)] = values
+        if len(real_time) == n_steps:
+            time = real_time
+
+    if cache_file is not None:
+        tmp = cache_file[:-4] + '.tmp.npz'
+        np.savez(tmp, realizations=np.asarray(realizations), signatures=signatures, time=time, curves=curves,
+                 items=np.asarray(items))
+        os.replace(tmp, cache_file)
+    return time, curves, items
+
+
+def arrival_times(time, curves, levels=(0.05, 0.5, 0.95)):
+    # (n_realization, n_items, n_levels) first time each level is reached, nan if never
+    levels = np.asarray(levels, dtype=np.float64)
+    reached = np.nan_to_num(curves, nan=-np.inf)[..., None] >= levels
+    first = reached.argmax(axis=1)
+    return np.where(reached.any(axis=1), time[first], np.nan)
+
+
+def peak_flux(time, curves):
+    # (n_realization, n_items) maximum of dF/dt and the time of the maximum
+    flux = np.diff(curves, axis=1)/np.diff(time)[:, None]
+    flux = np.nan_to_num(flux, nan=-np.inf)
+    k = flux.argmax(axis=1)
+    peak = np.take_along_axis(flux, k[:, None], axis=1)[:, 0]
+    # the flux of a step is given at the middle of the step
+    middle = (time[:-1] + time[1:])/2
+    return np.where(np.isfinite(peak), peak, np.nan), np.where(np.isfinite(peak), middle[k], np.nan)
+
+
+def breakthrough_statistics(time, curves, levels=(0.05, 0.5, 0.95), quantiles=(0.05, 0.5, 0.95)):
+    # ensemble quantiles of the arrival times and of the peak flux, per item
+    arrival = arrival_times(time, curves, levels)
+    peak, peak_time = peak_flux(time, curves)
+    with warnings.catch_warnings():
+        # an item no realization reaches has nan quantiles
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {'levels': np.asarray(levels), 'quantiles': np.asarray(quantiles),
+                'arrival': arrival, 'peak_flux': peak, 'peak_time': peak_time,
+                # (n_quantiles, n_items, n_levels), realizations that never reach a level are left out
+                'arrival_quantiles': np.nanquantile(arrival, quantiles, axis=0),
+                'peak_flux_quantiles': np.nanquantile(peak, quantiles, axis=0),
+                'peak_time_quantiles': np.nanquantile(peak_time, quantiles, axis=0),
+                # fraction of the realizations reaching every level by the end of the run
+                'reached': np.mean(np.isfinite(arrival), axis=0),
+                'mean_curve': np.nanmean(curves, axis=0)}
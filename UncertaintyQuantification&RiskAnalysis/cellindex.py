@@ -0,0 +1,126 @@
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from cfield_store import CFIELD_DIR, load_cfield
+
+# Cell-major index of the concentration fields, for time series queries.
+#
+# The ensemble store (ensemble.py) keeps one (nt, Ly, Lx) field per
+# realization, so the series of a single cell is spread over the whole file.
+# The index holds the same values transposed to (Ly, Lx, n_realization, nt):
+# the breakthrough curves of one cell in all realizations are one contiguous
+# block of n_realization*nt values, and the cells of a row of a box follow each
+# other. Breakthrough curves, peak concentrations and arrival times at wells,
+# boxes or polygons then only read the blocks of their cells.
+#
+# The index is filled one realization (or one block of realizations) at a time
+# and data_output/cfields/cell_index_done.npy flags the realizations written so
+# far, so it can be built incrementally while the transport runs finish and
+# resumed after an interruption. The flags of the realizations binned again
+# are cleared (invalidate), the next cellindex_postprocessing adds them back.
+
+INDEX_FILE = 'data_output/cfields/cell_index.npy'
+DONE_FILE = 'data_output/cfields/cell_index_done.npy'
+
+
+def _unshare(path):
+    # a file hard linked in the stage cache is copied before being modified
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        tmp = path + '.tmp'
+        shutil.copy2(path, tmp)
+        os.replace(tmp, path)
+
+
+def invalidate(reals, done_file=DONE_FILE):
+    # only the flag file is opened, not the index
+    if not os.path.exists(done_file):
+        return
+    _unshare(done_file)
+    done = np.load(done_file, mmap_mode='r+')
+    reals = np.atleast_1d(np.asarray(reals, dtype=np.intp))
+    done[reals[reals < len(done)]] = 0
+    done.flush()
+
+
+def polygon_cells(vertices, Lx, Ly):
+    # (x, y) of the cells whose centre lies inside the polygon, vertices in
+    # cell coordinates as the observation wells
+    vertices = np.asarray(vertices, dtype=np.float64)
+    y, x = np.mgrid[0:Ly, 0:Lx]
+    px, py = x.ravel() + 0.5, y.ravel() + 0.5
+    inside = np.zeros(px.shape, dtype=bool)
+    # ray casting, one pass per edge over all cells
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (py - y1)*(x2 - x1)/(y2 - y1)
+        inside ^= crosses & (px < x_cross)
+    return np.column_stack((px[inside], py[inside])).astype(np.intp)
+
+
+class CellIndex:
+    def __init__(self, path=INDEX_FILE, done_file=DONE_FILE, mode='r'):
+        if mode != 'r':
+            _unshare(path)
+            _unshare(done_file)
+        self.data = np.load(path, mmap_mode=mode)
+        self.done = np.load(done_file, mmap_mode=mode)
+
+    @classmethod
+    def create(cls, n_realization, field_shape, path=INDEX_FILE, done_file=DONE_FILE, dtype=np.float64):
+        nt, ny, nx = field_shape
+        open_memmap(path, mode='w+', dtype=dtype, shape=(ny, nx, n_realization, nt)).flush()
+        open_memmap(done_file, mode='w+', dtype=np.uint8, shape=(n_realization,)).flush()
+        return cls(path, done_file, mode='r+')
+
+    @property
+    def shape(self):
+        # (Ly, Lx, n_realization, nt)
+        return self.data.shape
+
+    def missing(self):
+        return np.flatnonzero(self.done == 0)
+
+    @property
+    def complete(self):
+        return bool(self.done.all())
+
+    def add(self, reals, fields):
+        # writes the (k, nt, Ly, Lx) fields of the k realizations reals
+        reals = np.atleast_1d(reals)
+        fields = np.asarray(fields).transpose(2, 3, 0, 1)
+        if np.array_equal(reals, np.arange(reals[0], reals[0] + len(reals))):
+            # consecutive realizations are contiguous runs of the file
+            self.data[:, :, reals[0]:reals[0] + len(reals)] = fields
+        else:
+            self.data[:, :, reals] = fields
+        self.data.flush()
+        self.done[reals] = 1
+        self.done.flush()
+
+    def add_realization(self, real, cfield_dir=CFIELD_DIR):
+        self.add(real, load_cfield(real, cfield_dir=cfield_dir)[None])
+
+    def series(self, cells):
+        # (n_cells, n_realization, nt) breakthrough curves at the (x, y) cells
+        cells = np.atleast_2d(np.asarray(cells, dtype=np.intp))
+        return np.stack([self.data[y, x] for x, y in cells])
+
+    def box(self, xl, xu, yl, yu):
+        # (yu - yl, xu - xl, n_realization, nt) curves of the cells of a box
+        return np.asarray(self.data[yl:yu, xl:xu])
+
+    def peak(self, cells):
+        # (n_cells, n_realization) maximum concentration over time
+        return np.stack([self.data[y, x].max(axis=-1) for x, y in np.atleast_2d(cells)])
+
+    def arrival(self, cells, threshold, dt=1):
+        # (n_cells, n_realization) first time the concentration reaches
+        # threshold, nan when it never does
+        times = []
+        for x, y in np.atleast_2d(cells):
+            above = self.data[y, x] >= threshold
+            times.append(np.where(above.any(axis=-1), above.argmax(axis=-1)*dt, np.nan))
+        return np.stack(times)
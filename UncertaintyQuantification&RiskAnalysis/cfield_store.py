@@ -0,0 +1,114 @@
+import os
+import numpy as np
+
+# Storage of the per-realization concentration fields in data_output/cfields.
+#
+# 'dense'  : cfield_{real}.npy, float64 concentrations (particle fraction per cell)
+# 'counts' : cfield_{real}.npz, compressed integer particle counts (uint16 when
+#            they fit, uint32 otherwise) plus the particle total
+# 'sparse' : cfield_{real}.npz, the nonzero cells of every time step in CSR
+#            layout (indptr over the time steps, flat cell indices, counts),
+#            compressed as well
+#
+# load_cfield returns the dense float64 concentrations whatever the format,
+# so the readers do not need to know how a realization was stored.
+
+CFIELD_DIR = 'data_output/cfields'
+STORAGE_MODES = ('dense', 'counts', 'sparse')
+
+
+def cfield_file(real, storage='dense', cfield_dir=CFIELD_DIR):
+    extension = 'npy' if storage == 'dense' else 'npz'
+    return f'{cfield_dir}/cfield_{real}.{extension}'
+
+
+def _count_dtype(counts):
+    return np.uint16 if counts.max(initial=0) <= np.iinfo(np.uint16).max else np.uint32
+
+
+def save_cfield(real, counts, particle_n, storage='dense', cfield_dir=CFIELD_DIR):
+    if storage not in STORAGE_MODES:
+        raise ValueError(f'unknown storage mode {storage}, use one of {STORAGE_MODES}')
+    path = cfield_file(real, storage, cfield_dir)
+    os.makedirs(cfield_dir, exist_ok=True)
+    # write under a temporary name first, so that an interrupted run never
+    # leaves a truncated file behind
+    tmp = path[:-4] + '.tmp' + path[-4:]
+    if storage == 'dense':
+        np.save(tmp, counts/particle_n)
+    elif storage == 'counts':
+        np.savez_compressed(tmp, counts=counts.astype(_count_dtype(counts)), particle_n=particle_n)
+    else:
+        nonzero = counts.reshape((len(counts), -1)) != 0
+        indptr = np.concatenate(([0], np.cumsum(np.count_nonzero(nonzero, axis=1))))
+        np.savez_compressed(tmp, shape=np.asarray(counts.shape), particle_n=particle_n,
+                 indptr=indptr, indices=np.nonzero(nonzero)[1].astype(np.uint32),
+                 data=counts[counts != 0].astype(_count_dtype(counts)))
+    os.replace(tmp, path)
+
+    # drop a file of this realization left over from another storage mode
+    other = cfield_file(real, 'counts' if storage == 'dense' else 'dense', cfield_dir)
+    if os.path.exists(other):
+        os.remove(other)
+
+
+def _decode(container, frames=None):
+    particle_n = container['particle_n']
+    if frames is not None:
+        frames = np.atleast_1d(frames)
+    if 'counts' in container:
+        counts = container['counts']
+        return (counts if frames is None else counts[frames])/particle_n
+    nt, ny, nx = container['shape']
+    indptr = container['indptr']
+    indices = container['indices']
+    data = container['data']
+    if frames is None:
+        frames = np.arange(nt)
+    field_c = np.zeros((len(frames), ny*nx))
+    for k, t in enumerate(frames):
+        field_c[k, indices[indptr[t]:indptr[t+1]]] = data[indptr[t]:indptr[t+1]]
+    return field_c.reshape((len(frames), ny, nx))/particle_n
+
+
+def load_cfield(real, mmap_mode=None, cfield_dir=CFIELD_DIR):
+    path = cfield_file(real, 'dense', cfield_dir)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode=mmap_mode)
+    with np.load(cfield_file(real, 'counts', cfield_dir)) as container:
+        return _decode(container)
+
+
+def load_cfield_frame(real, t, cfield_dir=CFIELD_DIR):
+    # a single time step, without decoding the whole realization when sparse
+    path = cfield_file(real, 'dense', cfield_dir)
+    if os.path.exists(path):
+        return np.array(np.load(path, mmap_mode='r')[t])
+    with np.load(cfield_file(real, 'counts', cfield_dir)) as container:
+        return _decode(container, t)[0]
+
+
+def iter_cfield_frames(real, frames, cfield_dir=CFIELD_DIR):
+    # the given time steps one at a time, read from the memory map when dense
+    # and decoded from the (compressed) arrays loaded once otherwise
+    path = cfield_file(real, 'dense', cfield_dir)
+    if os.path.exists(path):
+        field_c = np.load(path, mmap_mode='r')
+        for t in frames:
+            yield np.array(field_c[t])
+        return
+    with np.load(cfield_file(real, 'counts', cfield_dir)) as container:
+        container = {key: container[key] for key in container.files}
+    for t in frames:
+        yield _decode(container, t)[0]
+
+
+def cfield_shape(real, cfield_dir=CFIELD_DIR):
+    path = cfield_file(real, 'dense', cfield_dir)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r').shape
+    with np.load(cfield_file(real, 'counts', cfield_dir)) as container:
+        if 'shape' in container:
+            return tuple(int(n) for n in container['shape'])
+        return container['counts'].shape
+
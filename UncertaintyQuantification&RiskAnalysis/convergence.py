@@ -0,0 +1,128 @@
+from statistics import NormalDist
+import numpy as np
+
+from accumulators import RunningStats
+from cfield_store import load_cfield
+
+# Online convergence monitor of the Monte Carlo estimates.
+#
+# The concentration field of every new realization updates the running
+# ensemble statistics of the outputs of plotinfo:
+#
+# 'cfield'   ensemble mean concentration, (nt, Ly, Lx)
+# 'risk'     probability of exceeding mcl*c0, (nt, Ly, Lx) (risk_ensemble)
+# 'wells'    probability that the maximum concentration at each observation
+#            well exceeds mcl (obwells_maxconc, as in cdf_maxconc)
+# 'maxrisk'  mean of the maximum c/(mcl*c0) in the target area (maxrisk)
+#
+# For each quantity the half width of its confidence interval is tracked: the
+# normal interval of the mean for 'cfield' and 'maxrisk', relative to the
+# largest estimate, and the Agresti-Coull interval of a proportion for 'risk'
+# and 'wells', in absolute probability (it does not collapse to zero when no
+# realization exceeded the threshold yet). Fields are judged on their least
+# converged cell. A quantity has converged when its error stayed within the
+# tolerance for `patience` consecutive realizations, after min_realizations.
+#
+# During the simulations, on_complete and should_stop are the callbacks of the
+# drivers (transport.transport_simulation, rwpt.rwpt_simulation, and
+# hydrogen.field_generation / flow.flow_simulation for should_stop): every
+# finished realization is binned if needed and added to the estimates, and no
+# new realization is started once all the quantities converged.
+
+QUANTITIES = ('cfield', 'risk', 'wells', 'maxrisk')
+PROPORTIONS = ('risk', 'wells')
+
+
+class ConvergenceMonitor:
+    def __init__(self, info, tolerance=0.05, confidence=0.95, min_realizations=20, patience=5,
+                 quantities=QUANTITIES):
+        # tolerance: one value for all quantities or a dictionary per quantity
+        for name in quantities:
+            if name not in QUANTITIES:
+                raise ValueError(f'unknown quantity {name}, use some of {QUANTITIES}')
+        self.info = info
+        self.quantities = tuple(quantities)
+        self.tolerance = (dict(tolerance) if isinstance(tolerance, dict)
+                          else {name: tolerance for name in self.quantities})
+        self.z = NormalDist().inv_cdf(0.5 + confidence/2)
+        self.min_realizations = min_realizations
+        self.patience = patience
+        self.stats = {name: RunningStats() for name in self.quantities}
+        self.streak = {name: 0 for name in self.quantities}
+        self.converged_at = {name: None for name in self.quantities}
+        self.history = []
+
+    @property
+    def n(self):
+        return self.stats[self.quantities[0]].n
+
+    def _samples(self, field_c):
+        info = self.info
+        c0 = field_c[0].max()
+        samples = {}
+        if 'cfield' in self.quantities:
+            samples['cfield'] = field_c
+        if 'risk' in self.quantities:
+            samples['risk'] = field_c >= info.mcl*c0
+        if 'wells' in self.quantities:
+            wells = field_c[:, info.observation_wells.T[1], info.observation_wells.T[0]]
+            samples['wells'] = wells.max(axis=0) > info.mcl
+        if 'maxrisk' in self.quantities:
+            target = field_c[:, info.target_yl:info.target_yu, info.target_xl:info.target_xu]
+            samples['maxrisk'] = np.where(target >= info.mcl*c0, target/(info.mcl*c0), 0).max()
+        return samples
+
+    def error(self, name):
+        # half width of the confidence interval (relative for 'cfield' and 'maxrisk')
+        running = self.stats[name]
+        n = running.n
+        if n < 2:
+            return np.inf
+        if name in PROPORTIONS:
+            n_tilde = n + self.z**2
+            p_tilde = (running.mean*n + self.z**2/2)/n_tilde
+            return float(np.max(self.z*np.sqrt(p_tilde*(1 - p_tilde)/n_tilde)))
+        half_width = self.z*np.sqrt(running.m2/(n - 1)/n)
+        scale = np.max(np.abs(running.mean))
+        return float(np.max(half_width)/scale) if scale > 0 else np.inf
+
+    def update(self, field_c):
+        # adds one realization, returns True once every quantity has converged
+        for name, sample in self._samples(np.asarray(field_c)).items():
+            self.stats[name].update(sample)
+        errors = {name: self.error(name) for name in self.quantities}
+        for name, error in errors.items():
+            self.streak[name] = self.streak[name] + 1 if error <= self.tolerance[name] else 0
+            if self.converged_at[name] is None and self.n >= self.min_realizations and \
+                    self.streak[name] >= self.patience:
+                self.converged_at[name] = self.n
+        self.history.append(dict(errors, n=self.n))
+        return self.converged
+
+    def update_realization(self, real):
+        return self.update(load_cfield(real, mmap_mode='r'))
+
+    def on_complete(self, real):
+        # a PAR2 run leaves snapshot files, rwpt.py the field itself
+        if not self.info.cfield_valid(real):
+            self.info.process_realization(real)
+        self.update_realization(real)
+
+    @property
+    def converged(self):
+        return all(n is not None for n in self.converged_at.values())
+
+    def should_stop(self, *args):
+        # for the early-stopping callbacks of the simulation drivers
+        return self.converged
+
+    def estimates(self):
+        # running estimate and confidence half width of every quantity
+        return {name: {'mean': self.stats[name].mean, 'error': self.error(name), 'n': self.stats[name].n}
+                for name in self.quantities}
+
+    def report(self):
+        for name in self.quantities:
+            status = (f'converged after {self.converged_at[name]} realizations' if self.converged_at[name]
+                      else 'not converged')
+            print(f'{name:<8} error {self.error(name):.4f} (tolerance {self.tolerance[name]}), {status}')
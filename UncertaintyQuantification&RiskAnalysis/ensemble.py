@@ -0,0 +1,17 @@
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Out-of-core ensemble store: a single preallocated .npy file of shape
+# (n_realization, nt, Ly, Lx) that is filled one realization at a time and
+# read back through memory-mapped views, so that only the realization being
+# processed has to be resident in memory.
+
+ENSEMBLE_FILE = 'data_output/cfields/cfield_all.npy'
+
+
+def create_ensemble(n_realization, field_shape, path=ENSEMBLE_FILE, dtype=np.float64):
+    return open_memmap(path, mode='w+', dtype=dtype, shape=(n_realization,) + tuple(field_shape))
+
+
+def open_ensemble(path=ENSEMBLE_FILE, mode='r'):
+    return np.load(path, mmap_mode=mode)
@@ -0,0 +1,67 @@
+import numpy as np
+
+# Empirical exceedance probabilities of the maximum concentration at the
+# observation wells (obwells_maxconc, one row per well, one column per
+# realization).
+#
+# The samples of every well are sorted once. The exceedance probability
+# P(c_max > t) at any thresholds is then the fraction of samples after the
+# position of t in the sorted row, found by one np.searchsorted over all wells
+# and thresholds, so it is the exact empirical survival function, not a
+# histogram estimate.
+#
+# The confidence intervals come from a nonparametric bootstrap. A bootstrap
+# sample is a vector of multinomial weights, how many times each realization is
+# drawn; the weights of all samples form one (n_boot, n_realization) resampling
+# matrix, and the exceedances of every bootstrap sample, well and threshold are
+# a single product of this matrix with the exceedance indicators. The wells are
+# processed in blocks to bound the memory.
+
+
+def count_above(sorted_samples, thresholds):
+    # number of samples > t in every row of sorted_samples, (rows, len(thresholds))
+    rows, n = sorted_samples.shape
+    thresholds = np.ravel(np.asarray(thresholds, dtype=np.float64))
+    # the values are replaced by their ranks among all samples and thresholds,
+    # so every row can be shifted past the previous one exactly and a single
+    # searchsorted covers all rows
+    _, ranks = np.unique(np.concatenate((sorted_samples.ravel(), thresholds)), return_inverse=True)
+    ranks = ranks.ravel()
+    offset = (ranks.max() + 1)*np.arange(rows)[:, None]
+    keys = ranks[:rows*n].reshape((rows, n)) + offset
+    right = np.searchsorted(keys.ravel(), ranks[rows*n:] + offset, side='right')
+    return n*np.arange(1, rows + 1)[:, None] - right
+
+
+class Exceedance:
+    def __init__(self, samples):
+        self.samples = np.atleast_2d(np.asarray(samples, dtype=np.float64))
+        self.sorted = np.sort(self.samples, axis=1)
+        self.n = self.samples.shape[1]
+
+    def probability(self, thresholds):
+        # P(c_max > t), (n_wells, len(thresholds))
+        return count_above(self.sorted, thresholds)/self.n
+
+    def survival(self, well):
+        # sorted samples of a well and the survival function just after each of them
+        return self.sorted[well], (self.n - 1 - np.arange(self.n))/self.n
+
+    def bootstrap(self, thresholds, n_boot=1000, confidence=0.95, seed=0, block_size=2**24):
+        # percentile confidence interval of P(c_max > t), two (n_wells, len(thresholds)) arrays
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        rng = np.random.default_rng(seed)
+        weights = rng.multinomial(self.n, np.full(self.n, 1/self.n), size=n_boot).astype(np.float32)
+        n_wells, m = len(self.samples), len(thresholds)
+        wells_block = max(1, block_size//(self.n*m))
+        alpha = (1 - confidence)/2
+        lower = np.empty((n_wells, m))
+        upper = np.empty((n_wells, m))
+        for start in range(0, n_wells, wells_block):
+            block = slice(start, start + wells_block)
+            # (n_realization, wells*thresholds) exceedance indicators
+            above = (self.samples[block, :, None] > thresholds).astype(np.float32)
+            above = above.transpose(1, 0, 2).reshape((self.n, -1))
+            p = (weights @ above).reshape((n_boot, -1, m))/self.n
+            lower[block], upper[block] = np.quantile(p, (alpha, 1 - alpha), axis=0)
+        return lower, upper
@@ -0,0 +1,57 @@
+import mmap
+import re
+from functools import partial
+
+import numpy as np
+
+from parallel import run_realizations
+
+# Reader for the formatted flow-transport link files (model-{i}.ftl) written by
+# the MODFLOW LMT package.
+#
+# Every record starts with a header line holding a quoted label, e.g.
+#  'QXX             '   ...
+# followed by the values of the record. The file is memory mapped, the headers
+# are located with one regular-expression pass and the values of the flux
+# records (QXX, QYY, QZZ) are parsed in bulk with np.fromstring.
+
+FTL_FILE = 'tmp/model-{}.ftl'
+FLUX_LABELS = {b'QXX': 'X', b'QYY': 'Y', b'QZZ': 'Z'}
+_HEADER = re.compile(rb"^ *'([^'\n]*)'[^\n]*\n", re.MULTILINE)
+
+
+def read_ftl(path, shape=None, components=('X', 'Y', 'Z')):
+    # dictionary of the flux components found in the file, e.g. {'X': qxx, 'Y': qyy}
+    fluxes = {}
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        headers = list(_HEADER.finditer(buffer))
+        for k, header in enumerate(headers):
+            component = FLUX_LABELS.get(header.group(1).strip())
+            if component not in components:
+                continue
+            end = headers[k+1].start() if k+1 < len(headers) else len(buffer)
+            values = np.fromstring(buffer[header.end():end], sep=' ')
+            fluxes[component] = np.concatenate((fluxes[component], values)) if component in fluxes else values
+
+    if shape is not None:
+        fluxes = {component: values.reshape(shape) for component, values in fluxes.items()}
+    return fluxes
+
+
+def read_flux(real, shape, component='X', ftl_file=FTL_FILE):
+    fluxes = read_ftl(ftl_file.format(real), shape, (component,))
+    if component not in fluxes:
+        raise ValueError(f'no Q{component}{component} record in {ftl_file.format(real)}')
+    return fluxes[component]
+
+
+def load_flux_ensemble(n_realization, shape, component='X', n_workers=1, chunksize=None, ftl_file=FTL_FILE,
+                       profiler=None):
+    # (n_realization,) + shape array of one flux component of every realization
+    flux = np.zeros((n_realization,) + tuple(shape))
+    results = run_realizations(partial(read_flux, shape=shape, component=component, ftl_file=ftl_file),
+                               range(n_realization), n_workers, chunksize, f'ftl Q{component}{component}',
+                               profiler=profiler)
+    for real in range(n_realization):
+        flux[real] = results[real]
+    return flux
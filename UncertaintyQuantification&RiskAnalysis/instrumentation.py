@@ -0,0 +1,194 @@
+import cProfile
+import csv
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial, wraps
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Timing and resource instrumentation of the post-processing and generation runs.
+#
+# A Profiler records one entry per stage (a plotinfo method, the K-field
+# generation, ...) and one per task run by the process pool (a realization or a
+# block of realizations): wall time, CPU time, bytes read and written and peak
+# memory. The task metrics are measured in the worker that runs the task and
+# sent back with its result. The records are written as a JSON or CSV report.
+#
+# I/O counters come from /proc/self/io and are only available on Linux: io_*
+# counts the bytes passed through read/write calls, disk_* the bytes that hit
+# the storage (neither sees pages touched through a memory map). Peak memory is
+# the maximum resident set size of the process, or the peak of the allocations
+# traced by tracemalloc when trace_memory is on (slower, but per stage).
+# With cprofile on, every top-level stage is also profiled with cProfile in the
+# main process and its statistics dumped to profile_{stage}.prof.
+
+
+def _io_counters():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+    except OSError:
+        return None
+    return {'io_read': int(counters['rchar']), 'io_write': int(counters['wchar']),
+            'disk_read': int(counters['read_bytes']), 'disk_write': int(counters['write_bytes'])}
+
+
+def maxrss_mb(who):
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss/1024**2 if sys.platform == 'darwin' else maxrss/1024
+
+
+def children_cpu():
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Meter:
+    # wall/CPU time, I/O and memory of the current process between start and stop
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.traced_peak = 0
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self.io = _io_counters()
+        self.cpu = time.process_time()
+        self.children_cpu = children_cpu()
+        self.wall = time.perf_counter()
+
+    def stop(self):
+        metrics = {'wall_s': time.perf_counter() - self.wall,
+                   'cpu_s': time.process_time() - self.cpu,
+                   'children_cpu_s': children_cpu() - self.children_cpu}
+        io = _io_counters()
+        if io is not None and self.io is not None:
+            metrics.update({key: io[key] - self.io[key] for key in io})
+        metrics['peak_rss_mb'] = maxrss_mb(resource.RUSAGE_SELF) if resource else None
+        if self.trace_memory:
+            # the peak of a nested meter, reset in between, is passed up in traced_peak
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            metrics['peak_traced_mb'] = self.traced_peak/1024**2
+        return metrics
+
+
+def measure(func, arg, trace_memory=False):
+    # runs func(arg) and returns its result with the metrics of the call
+    meter = _Meter(trace_memory)
+    result = func(arg)
+    return result, dict(meter.stop(), pid=os.getpid())
+
+
+class Profiler:
+    def __init__(self, cprofile=False, trace_memory=False, report=None):
+        self.cprofile = cprofile
+        self.trace_memory = trace_memory
+        self.report = report
+        self.stages = []
+        self.tasks = []
+        self._stack = []
+        self._meters = []
+        self._worker = False
+
+    def __getstate__(self):
+        # a copy sent to a worker does not record anything itself
+        state = self.__dict__.copy()
+        state.update(stages=[], tasks=[], _stack=[], _meters=[], _worker=True)
+        return state
+
+    @contextmanager
+    def stage(self, name, **labels):
+        if self._worker:
+            yield
+            return
+        self._stack.append(name)
+        path = '/'.join(self._stack)
+        profile = cProfile.Profile() if self.cprofile and len(self._stack) == 1 else None
+        n_tasks = len(self.tasks)
+        meter = _Meter(self.trace_memory)
+        self._meters.append(meter)
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self._path(f'profile_{name}.prof'))
+            metrics = meter.stop()
+            self._meters.pop()
+            for outer in self._meters:
+                outer.traced_peak = max(outer.traced_peak, meter.traced_peak)
+            metrics['peak_children_rss_mb'] = maxrss_mb(resource.RUSAGE_CHILDREN) if resource else None
+            # I/O of the tasks run by other processes during the stage
+            for task in self.tasks[n_tasks:]:
+                if task['pid'] != os.getpid():
+                    for key in ('io_read', 'io_write', 'disk_read', 'disk_write'):
+                        if key in metrics and key in task:
+                            metrics[key] += task[key]
+            self.stages.append(dict(labels, stage=path, tasks=len(self.tasks) - n_tasks, **metrics))
+            self._stack.pop()
+            if self.report is not None and not self._stack:
+                self.write(self.report)
+
+    def task(self, func):
+        # picklable wrapper of func returning (result, metrics), see record_task
+        return partial(measure, func, trace_memory=self.trace_memory)
+
+    def record_task(self, label, item, metrics):
+        self.tasks.append(dict(metrics, stage='/'.join(self._stack + [label]), item=item))
+
+    def _path(self, filename):
+        directory = os.path.dirname(self.report) if self.report else ''
+        return os.path.join(directory, filename)
+
+    def records(self):
+        return ([dict(record, kind='stage') for record in self.stages] +
+                [dict(record, kind='task') for record in self.tasks])
+
+    def write(self, path):
+        # a JSON report ({'stages': [...], 'tasks': [...]}) or one CSV table
+        if path.endswith('.csv'):
+            records = self.records()
+            fields = []
+            for record in records:
+                fields += [key for key in record if key not in fields]
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(records)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'stages': self.stages, 'tasks': self.tasks}, f, indent=1, default=str)
+
+    def summary(self):
+        width = max([len(record['stage']) for record in self.stages] + [5]) + 2
+        print(f'{"stage":<{width}}{"wall [s]":>10}{"cpu [s]":>10}{"io read [MB]":>14}{"io write [MB]":>15}{"peak [MB]":>11}')
+        for record in self.stages:
+            peak = record.get('peak_traced_mb', record['peak_rss_mb'])
+            print(f'{record["stage"]:<{width}}{record["wall_s"]:>10.2f}'
+                  f'{record["cpu_s"] + record["children_cpu_s"]:>10.2f}'
+                  f'{record.get("io_read", 0)/1024**2:>14.1f}{record.get("io_write", 0)/1024**2:>15.1f}'
+                  f'{peak if peak is not None else float("nan"):>11.1f}')
+
+
+def profiled(method):
+    # records a plotinfo method as a stage when the instance has a profiler
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return method(self, *args, **kwargs)
+        with self.profiler.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
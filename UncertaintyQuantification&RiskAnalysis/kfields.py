@@ -0,0 +1,72 @@
+import json
+import os
+import numpy as np
+
+# Lazy access to the K-field ensemble (Kfileds_Hydrogen.npy).
+#
+# The file is memory mapped on first use, so reading one realization only
+# touches that realization. The global minimum and maximum used for the colour
+# scales are kept in a small sidecar file (Kfileds_Hydrogen.meta.json), which
+# is recomputed in one streaming pass when the .npy file changes.
+
+KFIELD_FILE = 'Kfileds_Hydrogen.npy'
+
+
+class KFieldStore:
+    def __init__(self, path=KFIELD_FILE):
+        self.path = path
+        self.meta_path = os.path.splitext(path)[0] + '.meta.json'
+        self._fields = None
+        self._metadata = None
+
+    def __getstate__(self):
+        # never pickle the memory map, the workers reopen the file
+        state = self.__dict__.copy()
+        state['_fields'] = None
+        return state
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = np.load(self.path, mmap_mode='r')
+        return self._fields
+
+    def __getitem__(self, real):
+        return np.asarray(self.fields[real])
+
+    def __len__(self):
+        return len(self.fields)
+
+    @property
+    def shape(self):
+        return self.fields.shape
+
+    def _signature(self):
+        stat = os.stat(self.path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            signature = self._signature()
+            try:
+                with open(self.meta_path) as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                metadata = {}
+            if {key: metadata.get(key) for key in signature} != signature:
+                metadata = dict(signature, shape=list(self.shape),
+                                min=float(min(np.min(field) for field in self.fields)),
+                                max=float(max(np.max(field) for field in self.fields)))
+                with open(self.meta_path, 'w') as f:
+                    json.dump(metadata, f)
+            self._metadata = metadata
+        return self._metadata
+
+    @property
+    def min(self):
+        return self.metadata['min']
+
+    @property
+    def max(self):
+        return self.metadata['max']
@@ -0,0 +1,72 @@
+import os
+import multiprocessing as mp
+
+# Process-pool execution of independent per-realization tasks.
+#
+# func is called once per realization (it has to be picklable, e.g. a
+# module-level function or a bound method of a picklable object) and the
+# results are collected in a dictionary keyed by realization number, so the
+# outcome does not depend on the order in which the workers finish. With a
+# profiler (instrumentation.Profiler) every task is measured in its worker and
+# recorded under label.
+#
+# on_complete(real) is called in the main process as soon as a realization is
+# done; when should_stop(real) returns True afterwards the tasks not finished
+# yet are cancelled and the results so far returned (early stopping, e.g. with
+# convergence.ConvergenceMonitor).
+
+
+def _call(task):
+    func, real = task
+    return real, os.getpid(), func(real)
+
+
+def default_chunksize(n_tasks, n_workers):
+    return max(1, n_tasks//(4*n_workers))
+
+
+def run_realizations(func, realizations, n_workers=1, chunksize=None, label='realization', item='realization no.',
+                     profiler=None, on_complete=None, should_stop=None):
+    realizations = list(realizations)
+    total = len(realizations)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, total))
+    if chunksize is None:
+        # one realization per task when the loop may stop early
+        chunksize = 1 if should_stop is not None else default_chunksize(total, n_workers)
+
+    results = {}
+    if profiler is not None:
+        func = profiler.task(func)
+    tasks = [(func, real) for real in realizations]
+    pool = None
+    if n_workers > 1:
+        pool = mp.Pool(n_workers)
+        iterator = pool.imap_unordered(_call, tasks, chunksize)
+    else:
+        iterator = map(_call, tasks)
+
+    try:
+        for done, (real, pid, result) in enumerate(iterator, 1):
+            if profiler is not None:
+                result, metrics = result
+                profiler.record_task(label, real, metrics)
+            results[real] = result
+            print(f'{label}: {item} {real} done by worker {pid} ({done}/{total})')
+            if on_complete is not None:
+                on_complete(real)
+            if should_stop is not None and should_stop(real):
+                print(f'{label}: stopped after {done} of {total}')
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+                return results
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,92 @@
+import argparse
+import sys
+import time
+
+# Command-line entry point of the post-processing chain, without Jupyter:
+#
+#   python rauq.py rauq.yaml [--stages rrfield well] [--workers 8] [--no-plots]
+#
+# The YAML file holds the parameters of plotinfo, the stages to run and the
+# plots to draw (see rauq.yaml). The stages are brought up to date with
+# plotinfo.postprocessing, so only what changed since the last run is
+# computed. Plotting libraries are only imported when there are plots to draw,
+# with the Agg backend.
+#
+# The time taken to import RAUQ_function is printed; --max-startup fails the
+# run when it is slower than the given number of seconds or when it imported
+# matplotlib, scipy or pandas.
+
+HEAVY_MODULES = ('matplotlib', 'scipy', 'pandas', 'seaborn')
+
+
+def _tstep(value):
+    import numpy as np
+    if isinstance(value, dict):
+        return np.arange(value['start'], value['stop'] + value['step'], value['step'])
+    return np.asarray(value)
+
+
+def make_plotinfo(plib, config, n_workers=None, profile=None):
+    return plib.plotinfo(config['n_realization'], config['Kg'], config['Lx'], config['Ly'],
+                         config.get('block_x', 1), config.get('block_y', 1), config['lambda_x'], config['lambda_y'],
+                         *config['source'], *config['target'], config['mcl'], config['observation_wells'],
+                         _tstep(config['tstep']), config['dt'],
+                         n_workers=n_workers or config.get('n_workers', 1), chunksize=config.get('chunksize'),
+                         snapshot_cache=config.get('snapshot_cache', True), storage=config.get('storage', 'dense'),
+                         profile=profile or False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the RAUQ post-processing chain from a YAML configuration.')
+    parser.add_argument('config', help='YAML file with the plotinfo parameters, stages and plots')
+    parser.add_argument('--stages', nargs='*', help='stages to bring up to date (default: the ones of the config)')
+    parser.add_argument('--force', action='store_true', help='run the stages even when they are up to date')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: n_workers of the config)')
+    parser.add_argument('--no-plots', action='store_true', help='skip the plots of the config')
+    parser.add_argument('--profile', help='write a timing report of the stages (.json or .csv)')
+    parser.add_argument('--max-startup', type=float, help='maximum import time of RAUQ_function in seconds')
+    args = parser.parse_args()
+
+    import yaml
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    start = time.perf_counter()
+    import RAUQ_function as plib
+    startup = time.perf_counter() - start
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f'RAUQ_function imported in {startup:.3f} s' + (f' (with {", ".join(heavy)})' if heavy else ''))
+    if args.max_startup is not None and (startup > args.max_startup or heavy):
+        sys.exit(f'startup target missed: {startup:.3f} s, limit {args.max_startup} s'
+                 + (f', imported {", ".join(heavy)}' if heavy else ''))
+
+    profiler = None
+    if args.profile:
+        from instrumentation import Profiler
+        profiler = Profiler(report=args.profile)
+    info = make_plotinfo(plib, config, args.workers, profiler)
+
+    stages = args.stages if args.stages is not None else config.get('stages') or []
+    info.postprocessing(*stages, force=args.force)
+    if config.get('risksweep'):
+        info.risksweep_postprocessing(config['risksweep'])
+    if config.get('breakthrough'):
+        info.breakthrough_postprocessing()
+
+    plots = [] if args.no_plots else config.get('plots') or []
+    if plots:
+        from rendering import use_agg
+        use_agg()
+    for plot in plots:
+        plot = dict(plot)
+        method = plot.pop('method')
+        if method.startswith('_') or not callable(getattr(info, method, None)):
+            sys.exit(f'unknown plot {method}')
+        getattr(info, method)(**plot)
+
+    if profiler is not None:
+        profiler.summary()
+
+
+if __name__ == '__main__':
+    main()
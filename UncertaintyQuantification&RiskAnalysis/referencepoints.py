@@ -0,0 +1,50 @@
+import numpy as np
+
+# Reference points of the plume (locations of the maximum concentration and
+# leading edge) computed for all the time steps of a realization with
+# whole-array reductions, and stored for all realizations in one columnar
+# table per kind (data_output/referencepoints/maxconc.npz and edge.npz).
+#
+# As before, the maximum concentration is tracked until it first drops to
+# c0*mcl, and the leading edge until it first reaches Lx - lambda_x.
+
+REFERENCEPOINTS_DIR = 'data_output/referencepoints'
+
+
+def maxconc_points(field_c, c0, mcl, lambda_x, dt):
+    field_c = field_c[:, :, :-lambda_x]
+    maxconc = field_c.max(axis=(1, 2))
+    tracked = np.logical_and.accumulate(maxconc > c0*mcl)
+    t, y, x = np.nonzero((field_c == maxconc[:, None, None]) & tracked[:, None, None])
+    return {'tstep': dt*t, 'x_coord': x, 'y_coord': y, 'conc': field_c[t, y, x]}
+
+
+def edge_points(field_c, Lx, lambda_x, dt):
+    plume_columns = (field_c != 0).any(axis=1)
+    nx = plume_columns.shape[1]
+    edge_x = nx - 1 - np.argmax(plume_columns[:, ::-1], axis=1)
+    tracked = np.logical_and.accumulate(plume_columns.any(axis=1) & (edge_x < Lx - lambda_x))
+    t = np.nonzero(tracked)[0]
+    edge_y = np.argmax(field_c[t, :, edge_x[t]], axis=1)
+    return {'tstep': dt*t, 'x_coord': edge_x[t], 'y_coord': edge_y}
+
+
+def concatenate(tables):
+    # tables: list of (realization, columns) pairs, in the order to be stored
+    columns = {'real': np.concatenate([np.full(len(table['tstep']), real) for real, table in tables])}
+    for key in tables[0][1]:
+        columns[key] = np.concatenate([table[key] for real, table in tables])
+    return columns
+
+
+def save_table(kind, columns, directory=REFERENCEPOINTS_DIR):
+    np.savez(f'{directory}/{kind}.npz', **columns)
+
+
+def load_table(kind, real=None, directory=REFERENCEPOINTS_DIR):
+    with np.load(f'{directory}/{kind}.npz') as table:
+        columns = {key: table[key] for key in table.files}
+    if real is not None:
+        selected = columns.pop('real') == real
+        columns = {key: values[selected] for key, values in columns.items()}
+    return columns
@@ -0,0 +1,161 @@
+import os
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib import animation
+from matplotlib.ticker import LinearLocator, FuncFormatter
+from copy import copy
+
+# Reusable map figure for the cfield, riskfield and resiliencefield plots.
+#
+# The static layers (K-field background, colorbar, wells, target area,
+# locators, labels) are built once; rendering a frame only swaps the image
+# data and colour limits of the map (set_data/set_clim) and the time label,
+# and the figure is closed when the template is. Workers rendering frames in
+# a process pool switch to the Agg backend first with use_agg().
+#
+# Movies are encoded one frame at a time by a matplotlib movie writer grabbing
+# the same figure after every update, no image files are written in between.
+
+
+def fmt(x, pos):
+    a, b = '{:.0e}'.format(x).split('e')
+    b = int(b)
+    return r'${} \times 10^{{{}}}$'.format(a, b)
+
+
+FIGURE_DIR = 'figures'
+
+
+def figure_file(filename, extension='png'):
+    # the figures folder is created with the first figure, not on import
+    os.makedirs(FIGURE_DIR, exist_ok=True)
+    return f'{FIGURE_DIR}/{filename}.{extension}'
+
+
+def use_agg():
+    plt.switch_backend('Agg')
+
+
+def show_figure(fig):
+    # figures are closed after saving, so display them explicitly in notebooks
+    if 'inline' in matplotlib.get_backend():
+        from IPython.display import display
+        display(fig)
+
+
+def movie_writer(filename, fps=5):
+    # ffmpeg and ImageMagick receive the frames through a pipe as they are
+    # drawn; the Pillow fallback keeps them in memory until the GIF is written
+    if animation.writers.is_available('ffmpeg'):
+        return animation.FFMpegWriter(fps=fps), figure_file(filename, 'mp4')
+    if animation.writers.is_available('imagemagick'):
+        return animation.ImageMagickWriter(fps=fps), figure_file(filename, 'gif')
+    return animation.PillowWriter(fps=fps), figure_file(filename, 'gif')
+
+
+class MapFigure:
+    def __init__(self, info, cmap, ylabel, alpha=1, background=None, time_label=True):
+        self.fig, self.ax = plt.subplots(figsize=(7,5))
+        ax = self.ax
+        extent = [0,info.Lx/info.lambda_x,info.Ly/info.lambda_y,0]
+        if background is not None:
+            ax.imshow(background, cmap='jet', extent=extent, vmin=info.kmin, vmax=info.kmax)
+        self.img = ax.imshow(np.zeros((info.Ly,info.Lx)), cmap=copy(plt.get_cmap(cmap)), extent=extent,
+                             vmin=0, vmax=1, alpha=alpha)
+        self.cbar = ax.figure.colorbar(self.img, ax=ax, fraction=0.041, pad=0.04, format=FuncFormatter(fmt))
+        self.cbar.ax.tick_params(labelsize=14)
+        self.cbar.ax.set_ylabel(ylabel, fontsize=25, fontname='Arial', labelpad=10)
+        ax.scatter(info.observation_wells.T[0]/info.lambda_x, info.observation_wells.T[1]/info.lambda_y,
+                   color='k', marker='^' ,s=50)
+
+        ax.xaxis.set_major_locator(LinearLocator(5))
+        ax.xaxis.set_minor_locator(LinearLocator(21))
+        ax.yaxis.set_major_locator(LinearLocator(5))
+        ax.yaxis.set_minor_locator(LinearLocator(21))
+
+        rectangle2 = plt.Rectangle((info.target_xl/info.lambda_x,info.target_yl/info.lambda_y),
+                                   (info.target_xu-info.target_xl)/info.lambda_x,
+                                   (info.target_yu-info.target_yl)/info.lambda_y,
+                                   fc='k', fill=None, linewidth=1.5)
+        ax.add_patch(rectangle2)
+
+        ax.set_xlim(0,info.Lx/info.lambda_x)
+        ax.set_ylim(0,info.Ly/info.lambda_y)
+        for label in ax.get_xticklabels() + ax.get_yticklabels():
+            label.set_fontsize(15)
+            label.set_fontname('Arial')
+        ax.tick_params(labelsize=15)
+        ax.set_xlabel(r'$x~/~\lambda_x$', fontsize=25, fontname='Arial', labelpad=5)
+        ax.set_ylabel(r'$y~/~\lambda_y$', fontsize=25, fontname='Arial', labelpad=5)
+
+        self.text = None
+        if time_label:
+            self.text = ax.text(5/info.lambda_x, 5/info.lambda_y, '', fontsize=15, color='k')
+        self.fig.tight_layout()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, data, vmin, vmax, time=None):
+        self.img.set_data(data)
+        self.img.set_clim(vmin, vmax)
+        self.cbar.solids.set_edgecolor("face")
+        if self.text is not None and time is not None:
+            self.text.set_text(f'$t={time}$')
+
+    def save(self, filename, dpi=200):
+        self.fig.savefig(figure_file(filename),dpi=dpi, bbox_inches='tight')
+        show_figure(self.fig)
+
+    def _fit_figure(self, pad=0.1):
+        # movie frames cannot be cropped when saved like the PNGs
+        # (bbox_inches='tight'), so resize the figure around its content once
+        bbox = self.fig.get_tightbbox().padded(pad)
+        width, height = self.fig.get_size_inches()
+        positions = [(ax, ax.get_position()) for ax in self.fig.axes]
+        self.fig.set_size_inches(bbox.width, bbox.height)
+        for ax, pos in positions:
+            ax.set_position([(pos.x0*width - bbox.x0)/bbox.width, (pos.y0*height - bbox.y0)/bbox.height,
+                             pos.width*width/bbox.width, pos.height*height/bbox.height])
+
+    def record(self, filename, fps=5, dpi=100):
+        # context manager around the movie, every grab() appends a frame
+        self._fit_figure()
+        self.writer, self.movie_file = movie_writer(filename, fps)
+        return self.writer.saving(self.fig, self.movie_file, dpi)
+
+    def grab(self):
+        self.writer.grab_frame()
+
+    def close(self):
+        plt.close(self.fig)
+
+
+class PlumeMarkers:
+    # plume edge and maximum concentration tracks drawn over a realization map
+    def __init__(self, ax, plume_edge, max_conc):
+        self.edge_now = self.edge_path = self.maxconc_now = self.maxconc_past = None
+        if plume_edge:
+            self.edge_now = ax.scatter([], [], s=80, c='b', marker='X', linewidths=.01, alpha=0.8, label='plume edge')
+            self.edge_path, = ax.plot([], [], c='b', linestyle=':', alpha=0.8)
+        if max_conc:
+            self.maxconc_now = ax.scatter([], [], s=80, c='r', marker='X', linewidths=.01, alpha=0.8, label='max C')
+            self.maxconc_past = ax.scatter([], [], s=30, c='r', marker='X', linewidths=.01, alpha=0.5)
+        if plume_edge or max_conc:
+            ax.legend(loc=2, fontsize=12)
+
+    @staticmethod
+    def _points(table, index, info):
+        return np.column_stack((table['x_coord'][index]/info.lambda_x, table['y_coord'][index]/info.lambda_y))
+
+    def update(self, info, i, edge, maxconc):
+        if self.edge_now is not None:
+            self.edge_now.set_offsets(self._points(edge, edge['tstep']//info.dt == i, info))
+            self.edge_path.set_data(*self._points(edge, edge['tstep']//info.dt <= i, info).T)
+        if self.maxconc_now is not None:
+            self.maxconc_now.set_offsets(self._points(maxconc, maxconc['tstep']//info.dt == i, info))
+            self.maxconc_past.set_offsets(self._points(maxconc, maxconc['tstep']//info.dt <= i, info))
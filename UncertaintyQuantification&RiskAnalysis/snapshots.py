@@ -0,0 +1,84 @@
+import os
+import numpy as np
+
+# Reader for the PAR2 particle snapshots (output/snap-{real}-{step}.csv).
+#
+# Only the x and y columns are parsed, straight into float32 buffers, and the
+# snapshots of one realization can be packed into a single binary container
+# (output/snap-{real}.npz) so that later runs do not parse the CSV files again.
+
+
+def snapshot_file(real, step, output_dir='output'):
+    return f'{output_dir}/snap-{real}-{step}.csv'
+
+
+def snapshot_container(real, output_dir='output'):
+    return f'{output_dir}/snap-{real}.npz'
+
+
+def snapshot_time(real, tstep, output_dir='output'):
+    # modification time of the particle files of a realization (the last CSV
+    # written, or the container when the CSV files were removed), None if none
+    for path in (snapshot_file(real, tstep[-1], output_dir), snapshot_container(real, output_dir)):
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+    return None
+
+
+def count_particles(path):
+    with open(path, 'rb') as f:
+        f.readline()
+        data = f.read()
+    return data.count(b'\n') + (0 if data.endswith(b'\n') or not data else 1)
+
+
+def read_snapshot(path, out=None, dtype=np.float32):
+    xy = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(1, 2), dtype=dtype, ndmin=2).T
+    if out is None:
+        return xy
+    out[...] = xy
+    return out
+
+
+def read_realization(real, tstep, output_dir='output', out=None, dtype=np.float32):
+    files = [snapshot_file(real, step, output_dir) for step in tstep]
+    if out is None:
+        out = np.empty((len(files), 2, count_particles(files[0])), dtype=dtype)
+    for i, path in enumerate(files):
+        read_snapshot(path, out[i])
+    return out
+
+
+def _container_valid(real, tstep, output_dir):
+    path = snapshot_container(real, output_dir)
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    for step in tstep:
+        csv = snapshot_file(real, step, output_dir)
+        # the CSV files may have been removed after packing
+        if os.path.exists(csv) and os.path.getmtime(csv) > mtime:
+            return False
+    return True
+
+
+def pack_realization(real, tstep, output_dir='output', remove_csv=False):
+    coordinates = read_realization(real, tstep, output_dir)
+    path = snapshot_container(real, output_dir)
+    np.savez(path[:-4] + '.tmp.npz', tstep=np.asarray(tstep), coordinates=coordinates)
+    os.replace(path[:-4] + '.tmp.npz', path)
+    if remove_csv:
+        for step in tstep:
+            os.remove(snapshot_file(real, step, output_dir))
+    return coordinates
+
+
+def load_realization(real, tstep, output_dir='output', cache=True):
+    # (nt, 2, particle_n) float32 array of the x and y particle coordinates
+    if _container_valid(real, tstep, output_dir):
+        with np.load(snapshot_container(real, output_dir)) as container:
+            if np.array_equal(container['tstep'], tstep):
+                return container['coordinates']
+    if cache:
+        return pack_realization(real, tstep, output_dir)
+    return read_realization(real, tstep, output_dir)
@@ -0,0 +1,301 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from cellindex import DONE_FILE, INDEX_FILE
+from cfield_store import cfield_file
+from ensemble import ENSEMBLE_FILE
+from ftl_reader import FTL_FILE
+from snapshots import snapshot_container, snapshot_file
+
+# Dependency-aware runner for the post-processing chain of plotinfo.
+#
+# Every stage declares the stages it reads from, the plotinfo parameters it
+# depends on, its raw input files and the files it writes. The key of a stage
+# is a hash of its parameters, of the signatures (size, modification time) of
+# its input files and of the keys of its upstream stages, so a new parameter
+# value only invalidates the stages using it and the ones downstream of them:
+# changing mcl reruns referencepoints, rrfield and maxriskresilience, the
+# particles are not binned again.
+#
+# The outputs of every run are copied into data_output/cache/{key}, and a
+# stage whose key is found there is restored (copied back) instead of being run
+# again, e.g. when going back to a previous mcl. Copies, not hard links: the
+# stage methods write their files in place (np.save, memory maps), also when
+# called directly, which would change every cached run sharing the file.
+#
+# The keys of the outputs currently in data_output are kept in
+# data_output/stages.json, with the signature of every output file as it was
+# written (size, modification time and, for the cached stages, a SHA-256 of its
+# content): a stage whose outputs changed since, e.g. because a stage method was
+# called directly with other parameters, is restored or run again.
+#
+# The stages writing one file per realization or arrays as large as the
+# ensemble (cfield, cfield_ensemble, rrfield, cellindex) are not cached, every
+# copy of their outputs would take as much disk as the ensemble itself; going
+# back to a previous mcl runs rrfield again and restores the reduced maps of
+# maxriskresilience. A cached run is dropped as soon as the
+# input files it was computed from changed, since it can no longer be restored.
+#
+# The per-realization stages (cfield, cellindex) resume: when only their input
+# files changed, e.g. new transport runs, they keep the outputs that are still
+# valid and only process the missing or outdated realizations, so the fields
+# binned while the runs were going (plotinfo.process_realization) or saved by
+# rwpt.py are not computed again. Their outputs are discarded only when one of
+# the parameters listed in `resume` (or of a stage upstream) changed. The same
+# holds when no state was recorded yet: the valid outputs already in
+# data_output are used.
+
+CACHE_DIR = 'data_output/cache'
+STATE_FILE = 'data_output/stages.json'
+
+
+def _cfield_inputs(info):
+    # the snapshot CSV files, or the packed container when they were removed;
+    # the fields saved by rwpt.py have no particle files and are their own input
+    paths = []
+    for real in range(info.n_realization):
+        files = [snapshot_file(real, step) for step in info.tstep]
+        if os.path.exists(files[0]):
+            paths += files
+        elif os.path.exists(snapshot_container(real)):
+            paths.append(snapshot_container(real))
+        else:
+            paths.append(cfield_file(real, info.storage))
+    return paths
+
+
+class Stage:
+    def __init__(self, name, upstream=(), parameters=(), inputs=None, outputs=None, resume=None, cache=True):
+        self.name = name
+        self.method = f'{name}_postprocessing'
+        self.upstream = upstream
+        self.parameters = parameters
+        self.inputs = inputs or (lambda info: [])
+        self.outputs = outputs
+        # the parameters the outputs of a resumable stage depend on, None when
+        # the stage always starts over
+        self.resume = resume
+        self.cache = cache
+
+
+STAGES = [
+    Stage('cfield', (), ('n_realization', 'Lx', 'Ly', 'block_x', 'block_y', 'tstep', 'storage'),
+          _cfield_inputs,
+          lambda info: [cfield_file(real, info.storage) for real in range(info.n_realization)],
+          resume=('Lx', 'Ly', 'block_x', 'block_y', 'tstep', 'storage'), cache=False),
+    Stage('referencepoints', ('cfield',), ('mcl', 'Lx', 'lambda_x', 'dt'),
+          outputs=lambda info: ['data_output/referencepoints/maxconc.npz',
+                                'data_output/referencepoints/edge.npz']),
+    Stage('cfield_ensemble', ('cfield',),
+          outputs=lambda info: [ENSEMBLE_FILE, 'data_output/cfields/cfield_ensemble.npy',
+                                'data_output/cfields/cfield_ensemble_v.npy'], cache=False),
+    Stage('rrfield', ('cfield_ensemble',), ('mcl', 'dt'),
+          outputs=lambda info: ['data_output/reliability_field.npy', 'data_output/resilience_field.npy',
+                                'data_output/risk_ensemble.npy', 'data_output/risk_ensemble_v.npy',
+                                'data_output/resilience_ensemble.npy', 'data_output/resilience_ensemble_v.npy'],
+          cache=False),
+    Stage('eta', (), ('n_realization', 'Lx', 'Ly', 'Kg', 'source_xu', 'source_yl', 'source_yu'),
+          lambda info: [FTL_FILE.format(real) for real in range(info.n_realization)],
+          lambda info: ['data_output/sflow.npy', 'data_output/eta.npy']),
+    Stage('maxriskresilience', ('cfield_ensemble', 'rrfield'),
+          ('mcl', 'target_xl', 'target_xu', 'target_yl', 'target_yu'),
+          outputs=lambda info: ['data_output/maxrisk.npy', 'data_output/maxresilience.npy']),
+    Stage('cellindex', ('cfield',),
+          outputs=lambda info: [INDEX_FILE, DONE_FILE], resume=(), cache=False),
+    Stage('well', ('cellindex',), ('observation_wells',),
+          outputs=lambda info: ['data_output/obwells_maxconc.npy']),
+]
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _output_signature(path, digest=False):
+    signature = _signature(path)
+    if signature is not None and digest:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        signature.append(sha.hexdigest())
+    return signature
+
+
+def _parameter(value):
+    value = np.asarray(value)
+    return value.tolist() if value.dtype != object else str(value)
+
+
+def _hash(description):
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _copy(src, dst):
+    # a new file (inode) replacing dst in one step
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    shutil.copy2(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+
+class StageRunner:
+    def __init__(self, info, stages=STAGES, cache_dir=CACHE_DIR, state_file=STATE_FILE):
+        self.info = info
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.state_file = state_file
+
+    def _state(self):
+        # {stage: {'key': ..., 'resume': ...}}
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {name: entry if isinstance(entry, dict) else {'key': entry} for name, entry in state.items()}
+
+    def _save_state(self, state):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def selected(self, names=()):
+        # the requested stages and everything upstream of them, in run order
+        needed = set()
+        pending = list(names or self.stages)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError(f'unknown stage {name}, use one of {list(self.stages)}')
+            if name not in needed:
+                needed.add(name)
+                pending += self.stages[name].upstream
+        return [name for name in self.stages if name in needed]
+
+    def hashes(self, names=()):
+        # the key of every stage, the hash of the parameters its resumable
+        # outputs depend on and the hash of its input files, each including
+        # the ones of the stages upstream
+        hashes = {}
+        for name in self.selected(names):
+            stage = self.stages[name]
+            description = {'stage': name,
+                           'parameters': {p: _parameter(getattr(self.info, p)) for p in stage.parameters},
+                           'inputs': [[path, _signature(path)] for path in stage.inputs(self.info)],
+                           'upstream': {up: hashes[up]['key'] for up in stage.upstream}}
+            resume = {'stage': name,
+                      'parameters': {p: _parameter(getattr(self.info, p)) for p in stage.resume or stage.parameters},
+                      'upstream': {up: hashes[up]['resume'] for up in stage.upstream}}
+            inputs = {'inputs': description['inputs'], 'upstream': {up: hashes[up]['inputs'] for up in stage.upstream}}
+            hashes[name] = {'key': _hash(description), 'resume': _hash(resume), 'inputs': _hash(inputs)}
+        return hashes
+
+    def keys(self, names=()):
+        return {name: hashes['key'] for name, hashes in self.hashes(names).items()}
+
+    def _cache_path(self, key, path):
+        return os.path.join(self.cache_dir, key, path)
+
+    def _cached(self, key):
+        return os.path.exists(self._cache_path(key, 'stage.json'))
+
+    def _store(self, name, hashes, outputs):
+        for path in outputs:
+            _copy(path, self._cache_path(hashes['key'], path))
+        with open(self._cache_path(hashes['key'], 'stage.json'), 'w') as f:
+            json.dump({'stage': name, 'outputs': outputs, 'inputs': hashes['inputs']}, f, indent=1)
+
+    def _restore(self, key, outputs):
+        for path in outputs:
+            _copy(self._cache_path(key, path), path)
+
+    def _outputs(self, stage):
+        # the signatures of the output files, as recorded in stages.json
+        return {path: _output_signature(path, stage.cache) for path in stage.outputs(self.info)}
+
+    def _status(self, name, key, state):
+        entry = state.get(name, {})
+        outputs = self._outputs(self.stages[name])
+        if entry.get('key') == key and None not in outputs.values() and entry.get('outputs') == outputs:
+            return 'up to date'
+        if self.stages[name].cache and self._cached(key):
+            return 'cached'
+        return 'outdated'
+
+    def status(self, *names):
+        state = self._state()
+        return {name: self._status(name, key, state) for name, key in self.keys(names).items()}
+
+    def run(self, *names, force=False):
+        # force reruns the requested stages (all when none is given) even if
+        # they are up to date or cached
+        state = self._state()
+        forced = set(names or self.stages) if force else set()
+        selected = self.hashes(names)
+        for name, hashes in selected.items():
+            stage = self.stages[name]
+            key = hashes['key']
+            outputs = stage.outputs(self.info)
+            status = 'outdated' if name in forced else self._status(name, key, state)
+            if status == 'up to date':
+                print(f'{name}: up to date')
+                continue
+            if status == 'cached':
+                self._restore(key, outputs)
+                print(f'{name}: restored from cache')
+            else:
+                for path in outputs:
+                    # an output still hard linked in a cache written by an
+                    # earlier version is unlinked before being written again;
+                    # the resumable stages replace their files or copy them
+                    # first (cfield_store.save_cfield, cellindex)
+                    if stage.resume is None and os.path.exists(path) and os.stat(path).st_nlink > 1:
+                        os.remove(path)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                if stage.resume is None:
+                    print(f'{name}: running')
+                    getattr(self.info, stage.method)()
+                else:
+                    # nothing recorded: the outputs found are used as they are
+                    recorded = state.get(name, {}).get('resume', hashes['resume'])
+                    resume = name not in forced and recorded == hashes['resume']
+                    print(f'{name}: running' + (', keeping the valid outputs' if resume else ''))
+                    getattr(self.info, stage.method)(resume=resume)
+                if stage.cache:
+                    self._store(name, hashes, outputs)
+            state[name] = dict(hashes, outputs=self._outputs(stage))
+            self._save_state(state)
+        self.prune(selected)
+
+    def prune(self, hashes):
+        # drop the cached runs computed from other input files than the
+        # current ones, and the ones of stages no longer cached
+        if not os.path.isdir(self.cache_dir):
+            return
+        for key in os.listdir(self.cache_dir):
+            try:
+                with open(self._cache_path(key, 'stage.json')) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                continue
+            name = cached['stage']
+            if name in self.stages and not self.stages[name].cache or \
+                    name in hashes and cached.get('inputs') != hashes[name]['inputs']:
+                shutil.rmtree(os.path.join(self.cache_dir, key))
+
+    def clear_cache(self):
+        # drop the cached runs whose outputs are not the current ones
+        current = {entry['key'] for entry in self._state().values()}
+        if not os.path.isdir(self.cache_dir):
+            return
+        for key in os.listdir(self.cache_dir):
+            if key not in current:
+                shutil.rmtree(os.path.join(self.cache_dir, key))